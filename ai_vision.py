@@ -1,42 +1,212 @@
-import json
+import hashlib
+import io
 import os
+import threading
+import time
+import traceback
+from concurrent import futures
 
 import azure.ai.vision as sdk
-import requests
 
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+import bulk_vectorize
+import cache
+import embedding_store
+import http_clients
+import image_previews
+import ivf_index
+import metrics
+import resilience
 import utilities as utils
+from image_index import ShardedIndex
+
+config = utils.config
+services = {}
+services_lock = threading.Lock()
+
+imageset_indexes = {}
+imageset_index_locks = {}
+imageset_index_locks_lock = threading.Lock()
+INDEX_RETRY_INTERVAL = 60
+search_executor = futures.ThreadPoolExecutor(max_workers=config['search_workers'])
+
+VECTORIZE_MODEL_VERSION = 'latest'
+RETRIED_ANALYSIS_ERRORS = {
+    sdk.ImageAnalysisErrorReason.TOO_MANY_REQUESTS,
+    sdk.ImageAnalysisErrorReason.CONNECTION_FAILURE,
+    sdk.ImageAnalysisErrorReason.SERVICE_TIMEOUT,
+    sdk.ImageAnalysisErrorReason.SERVICE_ERROR,
+    sdk.ImageAnalysisErrorReason.SERVICE_UNAVAILABLE,
+}
+text_vector_cache = cache.TieredCache(
+    cache.LRUCache(max_entries=config['text_cache_size']),
+    cache.SqliteCache(config['text_cache_path'], ttl=config['text_cache_ttl'])
+    if config['text_cache_path'] else None)
+image_analysis_cache = cache.LRUCache(max_entries=config['image_cache_size'],
+                                      ttl=config['image_cache_ttl'])
+preprocessed_images = cache.LRUCache(max_entries=64, ttl=600)
+metrics.register_cache('text_vectors_memory', text_vector_cache.memory)
+if text_vector_cache.persistent is not None:
+    metrics.register_cache('text_vectors_sqlite', text_vector_cache.persistent)
+metrics.register_cache('image_analysis', image_analysis_cache)
+
+
+def get_service():
+    """Get the Azure AI Vision SDK service and analysis options, creating them on first use.
+
+    They are created again when vision_key or vision_endpoint changed in config.
+
+    :return tuple: (sdk.VisionServiceOptions, sdk.ImageAnalysisOptions)
+    """
+    key = (config['vision_endpoint'], config['vision_key'])
+    with services_lock:
+        if key not in services:
+            services.clear()
+            service = sdk.VisionServiceOptions(key=key[1], endpoint=key[0])
+            analysis_options = sdk.ImageAnalysisOptions()
+            analysis_options.features = (
+                sdk.ImageAnalysisFeature.CAPTION
+            )
+            analysis_options.language = "en"
+            services[key] = (service, analysis_options)
+        return services[key]
+
+
+def get_image_digest(image_data):
+    """Get the content hash an image is cached under.
+
+    :param bytes image_data: Image content
+    :rtype: str
+    """
+    return hashlib.sha256(image_data).hexdigest()
+
+
+def preprocess_image(image_data):
+    """Downscale and re-encode an image before it is uploaded to Azure AI Vision.
+
+    Images whose longest edge exceeds image_max_edge are resized to it and
+    re-encoded as JPEG at image_jpeg_quality. Smaller images, images Pillow
+    cannot read, and re-encodes that turn out larger are sent unchanged.
+    Does nothing when image_max_edge is 0 or Pillow is not installed.
 
-config = utils.read_config()
-service = sdk.VisionServiceOptions(key=config['vision_key'],
-                                   endpoint=config['vision_endpoint'])
+    :param bytes image_data: Image content
+    :return bytes: Image content to upload
+    """
+    max_edge = config['image_max_edge']
+    if not max_edge or Image is None:
+        return image_data
+    digest = get_image_digest(image_data)
+    processed = preprocessed_images.get(digest)
+    if processed is not None:
+        return processed
+    processed = image_data
+    try:
+        with Image.open(io.BytesIO(image_data)) as image:
+            if max(image.size) > max_edge:
+                image.thumbnail((max_edge, max_edge))
+                output = io.BytesIO()
+                image.convert('RGB').save(output, format='JPEG',
+                                          quality=config['image_jpeg_quality'])
+                if output.tell() < len(image_data):
+                    processed = output.getvalue()
+    except (OSError, Image.DecompressionBombError) as e:
+        print(f"Image preprocessing skipped: {e}")
+    preprocessed_images.set(digest, processed)
+    return processed
+
+
+def read_image(file_name):
+    with open(file_name, 'rb') as f:
+        return f.read()
+
+
+def classify_analysis(result):
+    """Classify an SDK analysis result for resilience.Upstream.call.
+
+    Throttling, connection and server side failures are retried, any other result is final.
+    """
+    if result.reason == sdk.ImageAnalysisResultReason.ANALYZED:
+        return resilience.OK, None
+    if sdk.ImageAnalysisErrorDetails.from_result(result).reason in RETRIED_ANALYSIS_ERRORS:
+        return resilience.RETRY, None
+    return resilience.OK, None
 
-analysis_options = sdk.ImageAnalysisOptions()
-analysis_options.features = (
-    sdk.ImageAnalysisFeature.CAPTION
-)
-analysis_options.language = "en"
+
+def post_vision(url, **kwargs):
+    """POST to Azure AI Vision through the vision upstream's limiter, retries and breaker.
+
+    :param str url: Request URL
+    :return httpx.Response: Successful response
+    :raise resilience.UpstreamError: When Azure AI Vision is unavailable or rejected the request
+    """
+    response = resilience.get_upstream('vision').call(
+        lambda: http_clients.get_client('vision').post(url=url, **kwargs))
+    if response.status_code >= 400:
+        raise resilience.UpstreamError(f'vision answered {response.status_code} {response.text}')
+    return response
+
+
+def create_image_source(image_url=None, image_data=None):
+    """Create an SDK image source reading an image URL or content.
+
+    :param str image_url: Image URL, used when image_data is None
+    :param bytes image_data: Image content
+    :rtype: sdk.VisionSource
+    """
+    if image_data is None:
+        return sdk.VisionSource(url=image_url)
+    image_buffer = sdk.ImageSourceBuffer()
+    image_buffer.image_writer.write(image_data)
+    image_buffer.close()
+    return sdk.VisionSource(image_source_buffer=image_buffer)
 
 
-def get_image_caption(image_url=None, file_name=None):
+def get_image_caption(image_url=None, file_name=None, image_data=None):
     """Get image caption from Azure AI Vision API.
 
+    Image content is handed to the SDK from memory, after preprocess_image
+    downscaled it. Successful results for
+    files and content are cached under the hash of the content, so a re-sent
+    image is answered without calling Azure.
+
     :param file_name: Image file path
     :param str image_url : Image URL
+    :param bytes image_data: Image content
     :return dict response : Response from Azure AI Vision API
+    :raise resilience.UpstreamUnavailableError: When Azure AI Vision is unavailable
     """
-    image_source = None
-    if image_url is not None:
-        image_source = sdk.VisionSource(url=image_url)
+    cache_key = None
+    processed = None
     if file_name is not None:
-        image_source = sdk.VisionSource(filename=file_name)
-    image_analyzer = sdk.ImageAnalyzer(service, image_source, analysis_options)
-    result = image_analyzer.analyze()
+        image_data = read_image(file_name)
+    if image_data is not None:
+        cache_key = f'caption:{get_image_digest(image_data)}'
+        response = image_analysis_cache.get(cache_key)
+        if response is not None:
+            return response
+        with metrics.timed('preprocess_image'):
+            processed = preprocess_image(image_data)
+    service, analysis_options = get_service()
+
+    def analyze():
+        # an image buffer is drained by the attempt reading it, so every attempt gets its own
+        image_source = create_image_source(image_url, processed)
+        return sdk.ImageAnalyzer(service, image_source, analysis_options).analyze()
+
+    with metrics.timed('caption'):
+        result = resilience.get_upstream('vision').call(analyze, classify_analysis)
     response = {}
     if result.reason == sdk.ImageAnalysisResultReason.ANALYZED:
         response['status'] = 'success'
         if result.caption is not None:
             response['caption'] = result.caption.content
             response['confidence'] = result.caption.confidence
+        if cache_key is not None:
+            image_analysis_cache.set(cache_key, response)
     else:
         response['status'] = 'failed'
         error_details = sdk.ImageAnalysisErrorDetails.from_result(result)
@@ -47,58 +217,212 @@ def get_image_caption(image_url=None, file_name=None):
     return response
 
 
-def get_vectorize_image(image_path):
+def get_vectorize_image(image_path=None, image_data=None):
     """Get vectorize image from Azure AI Vision API.
 
+    Results are cached under the hash of the image content, which is
+    downscaled by preprocess_image before it is uploaded.
+
     :param str image_path: Image file path
+    :param bytes image_data: Image content, used instead of reading image_path
     :return list image_vector : Image vector
     """
-    with open(image_path, 'rb') as f:
-        image_data = f.read()
+    if image_data is None:
+        image_data = read_image(image_path)
+    cache_key = f'vector:{get_image_digest(image_data)}'
+    image_vector = image_analysis_cache.get(cache_key)
+    if image_vector is not None:
+        return image_vector
     url = (
         f'{config["vision_endpoint"]}computervision/retrieval:vectorizeImage?api-version=2023-02-01'
-        f'-preview&modelVersion=latest')
+        f'-preview&modelVersion={VECTORIZE_MODEL_VERSION}')
     headers = {'Content-type': 'application/octet-stream',
                'Ocp-Apim-Subscription-Key': config['vision_key']}
-    result = requests.post(url=url, headers=headers, data=image_data)
+    with metrics.timed('preprocess_image'):
+        image_data = preprocess_image(image_data)
+    with metrics.timed('vectorize_image'):
+        result = post_vision(url, headers=headers, content=image_data)
     image_vector = result.json()['vector']
+    image_analysis_cache.set(cache_key, image_vector)
     return image_vector
 
 
 def get_vectorize_text(text):
     """Get vectorize text from Azure AI Vision API.
 
+    Results are cached on the normalized text and model version, so repeated
+    prompts skip the network entirely.
+
     :param str text: Text
     :return list text_vector : Text vector
     """
+    key = f'{VECTORIZE_MODEL_VERSION}:{utils.normalize_text(text)}'
+    text_vector = text_vector_cache.get(key)
+    if text_vector is not None:
+        return text_vector
     url = (
         f'{config["vision_endpoint"]}computervision/retrieval:vectorizeText?api-version=2023-02-01'
-        f'-preview&modelVersion=latest')
+        f'-preview&modelVersion={VECTORIZE_MODEL_VERSION}')
     headers = {'Content-type': 'application/json',
                'Ocp-Apim-Subscription-Key': config['vision_key']}
     data = {'text': text}
-    result = requests.post(url=url, headers=headers, json=data)
+    with metrics.timed('vectorize_text'):
+        result = post_vision(url, headers=headers, json=data)
     text_vector = result.json()['vector']
+    text_vector_cache.set(key, text_vector)
     return text_vector
 
 
 def vectorize_imageset(imageset_path):
     """Vectorize imageset.
 
+    Indexing is incremental: only new or changed image files are vectorized,
+    removed files are dropped and the store is left untouched when nothing
+    changed. A legacy imageset_embeddings.json cache is migrated first.
+    Changed images are vectorized concurrently and checkpointed to the
+    pending file as they complete, so an interrupted run resumes where it
+    stopped. Previews of
+    the indexed images are generated alongside.
+
     :param str imageset_path: Imageset path
-    :return str imageset_embeddings_path : Imageset embeddings path
+    :return tuple: (ImageIndex, number of images that failed to vectorize and may succeed
+        when retried, images the service rejected are not counted)
     """
-    result_path = f'{imageset_path}/imageset_embeddings.json'
-    if os.path.exists(result_path):
-        with open(result_path) as f:
-            imageset_vector = json.load(f)
-        return imageset_vector
-    imageset_vector = {}
-    for image in os.listdir(imageset_path):
-        image_path = f'{imageset_path}/{image}'
-        image_vector = get_vectorize_image(image_path)
-        imageset_vector[image] = image_vector
-        print(f'Vectorize image: {image}')
-    with open(result_path, 'w') as f:
-        json.dump(imageset_vector, f)
-    return imageset_vector
+    index = None
+    metadata = {}
+    if embedding_store.store_exists(imageset_path):
+        index, metadata = embedding_store.load_store(imageset_path)
+    elif os.path.exists(os.path.join(imageset_path, embedding_store.JSON_FILE)):
+        embedding_store.convert_json_store(imageset_path)
+        index, metadata = embedding_store.load_store(imageset_path)
+
+    kept, changed = embedding_store.diff_imageset(imageset_path, metadata)
+    if index is not None and not changed and kept == metadata:
+        image_previews.build_previews(imageset_path, index.image_names)
+        return index, 0
+
+    removed = len(metadata.keys() - kept.keys() - changed.keys())
+    if removed:
+        print(f'Removed {removed} image(s) from index')
+
+    # vectors checkpointed by an interrupted run are reused if their file did not change since
+    new_vectors = {name: vector
+                   for name, (previous, vector) in embedding_store.load_pending(imageset_path).items()
+                   if name in changed and previous.get('sha256') == changed[name]['sha256']}
+    if new_vectors:
+        print(f'Resuming with {len(new_vectors)} image(s) vectorized by an interrupted run')
+
+    def save_checkpoint(vectors):
+        embedding_store.append_pending(imageset_path, vectors, changed)
+
+    failed = {}
+    to_vectorize = [name for name in changed if name not in new_vectors]
+    if to_vectorize:
+        vectors, failed = bulk_vectorize.bulk_vectorize(
+            imageset_path, to_vectorize, config['vision_endpoint'], config['vision_key'],
+            workers=config['vectorize_workers'], rate=config['vectorize_rate_limit'],
+            on_checkpoint=save_checkpoint)
+        new_vectors.update(vectors)
+    rejected = [name for name, e in failed.items()
+                if isinstance(e, bulk_vectorize.ImageRejectedError)]
+    if rejected:
+        print(f'{len(rejected)} image(s) were rejected by Azure AI Vision '
+              f'and are left out of the index')
+    if len(failed) > len(rejected):
+        print(f'{len(failed) - len(rejected)} image(s) failed to vectorize and will be retried later')
+    # the store is only rewritten when rows are added or dropped or metadata was refreshed,
+    # as rewriting it also invalidates the IVF index built from it
+    if index is None or new_vectors or kept != metadata:
+        # keep the on-disk dtype, e.g. of a store converted with --dtype float16
+        dtype = index.matrix.dtype.name if index is not None else 'float32'
+        embedding_store.save_index(imageset_path,
+                                   embedding_store.merge_index(index, list(kept), new_vectors),
+                                   dtype=dtype,
+                                   metadata={**kept, **{name: changed[name] for name in new_vectors}})
+        embedding_store.remove_pending(imageset_path)
+        index = embedding_store.load_index(imageset_path)
+    image_previews.build_previews(imageset_path, index.image_names)
+    return index, len(failed) - len(rejected)
+
+
+def load_imageset_index(imageset_path):
+    """Load the similarity index of an imageset, vectorizing it if needed.
+
+    The index is built once per imageset and kept in memory for later queries.
+    An index missing images that failed to vectorize, e.g. while Azure AI
+    Vision was down, is rebuilt in the background by the first query made
+    INDEX_RETRY_INTERVAL seconds later, queries keep using it meanwhile.
+    With ann_enabled, imagesets of at least ann_min_images images are searched
+    through an approximate IVF index instead of exhaustively. Otherwise
+    imagesets larger than shard_size are split into shards scored in parallel
+    on search_executor.
+
+    :param str imageset_path: Imageset path
+    :rtype: ImageIndex, ShardedIndex or ivf_index.IVFIndex
+    """
+    key = os.path.normpath(imageset_path)
+    entry = imageset_indexes.get(key)
+    if entry is not None:
+        if is_retry_due(entry) and not get_index_lock(key).locked():
+            threading.Thread(target=retry_imageset_index, args=(imageset_path,),
+                             daemon=True).start()
+        return entry[0]
+    with get_index_lock(key):
+        entry = imageset_indexes.get(key)
+        if entry is None:
+            entry = build_imageset_index(imageset_path)
+        return entry[0]
+
+
+def build_imageset_index(imageset_path):
+    """Build the index of an imageset and keep it, see load_imageset_index.
+
+    Must be called holding the lock of the imageset.
+
+    :param str imageset_path: Imageset path
+    :return tuple: (index, time.monotonic() a rebuild is due at, None if complete)
+    """
+    with metrics.timed('load_index'):
+        index, failed = vectorize_imageset(imageset_path)
+        if config['ann_enabled'] and len(index) >= config['ann_min_images']:
+            index = ivf_index.load_or_build(imageset_path, index,
+                                            n_lists=config['ann_lists'] or None,
+                                            n_probe=config['ann_probe'])
+        elif config['shard_size'] and len(index) > config['shard_size']:
+            index = ShardedIndex.split(index, config['shard_size'], search_executor)
+    retry_at = time.monotonic() + INDEX_RETRY_INTERVAL if failed else None
+    entry = imageset_indexes[os.path.normpath(imageset_path)] = (index, retry_at)
+    return entry
+
+
+def retry_imageset_index(imageset_path):
+    """Rebuild an index missing failed images, unless it is already being rebuilt."""
+    key = os.path.normpath(imageset_path)
+    lock = get_index_lock(key)
+    if not lock.acquire(blocking=False):
+        return
+    try:
+        entry = imageset_indexes[key]
+        if is_retry_due(entry):
+            try:
+                build_imageset_index(imageset_path)
+            except Exception:
+                traceback.print_exc()
+                imageset_indexes[key] = (entry[0], time.monotonic() + INDEX_RETRY_INTERVAL)
+    finally:
+        lock.release()
+
+
+def get_index_lock(key):
+    """Get the lock serializing the builds of one imageset, so imagesets are built independently.
+
+    :param str key: Normalized imageset path
+    :rtype: threading.Lock
+    """
+    with imageset_index_locks_lock:
+        return imageset_index_locks.setdefault(key, threading.Lock())
+
+
+def is_retry_due(entry):
+    """Check whether a kept (index, retry_at) entry is due for a rebuild."""
+    return entry[1] is not None and time.monotonic() >= entry[1]
@@ -1,96 +1,182 @@
-import datetime
-import json
-import os
+import asyncio
+import threading
 import time
+import traceback
+import uuid
 
 import httpx
-import openai
-import requests
 
+import generated_images
+import http_clients
+import metrics
+import resilience
 import utilities as utils
 
-config = utils.read_config()
-
-
-class CustomHTTPTransport(httpx.HTTPTransport):
-    def handle_request(
-            self,
-            request: httpx.Request,
-    ) -> httpx.Response:
-        if "images/generations" in request.url.path and request.url.params[
-            "api-version"
-        ] in [
-            "2023-06-01-preview",
-            "2023-07-01-preview",
-            "2023-08-01-preview",
-            "2023-09-01-preview",
-            "2023-10-01-preview",
-        ]:
-            request.url = request.url.copy_with(path="/openai/images/generations:submit")
-            response = super().handle_request(request)
-            operation_location_url = response.headers["operation-location"]
-            request.url = httpx.URL(operation_location_url)
-            request.method = "GET"
-            response = super().handle_request(request)
-            response.read()
-
-            timeout_secs: int = 120
-            start_time = time.time()
-            while response.json()["status"] not in ["succeeded", "failed"]:
-                if time.time() - start_time > timeout_secs:
-                    timeout = {
-                        "error": {"code": "Timeout", "message": "Operation polling timed out."}}
-                    return httpx.Response(
-                        status_code=400,
-                        headers=response.headers,
-                        content=json.dumps(timeout).encode("utf-8"),
-                        request=request,
-                    )
-
-                time.sleep(int(response.headers.get("retry-after")) or 10)
-                response = super().handle_request(request)
-                response.read()
-
-            if response.json()["status"] == "failed":
-                error_data = response.json()
-                return httpx.Response(
-                    status_code=400,
-                    headers=response.headers,
-                    content=json.dumps(error_data).encode("utf-8"),
-                    request=request,
-                )
-
-            result = response.json()["result"]
-            return httpx.Response(
-                status_code=200,
-                headers=response.headers,
-                content=json.dumps(result).encode("utf-8"),
-                request=request,
-            )
-        return super().handle_request(request)
-
-
-client = openai.AzureOpenAI(
-    azure_endpoint=config['aoai_endpoint'],
-    api_key=config['aoai_key'],
-    api_version='2023-10-01-preview',
-    http_client=httpx.Client(
-        transport=CustomHTTPTransport(),
-    ),
-)
+config = utils.config
+
+API_VERSION = '2023-10-01-preview'
+
+
+class ImageGenerationError(Exception):
+    """Raised when Azure OpenAI fails or times out generating an image."""
+
+
+class ImageGenerationJobs:
+    """Asynchronous image generation jobs on one shared event loop.
+
+    Submitting a prompt returns a job id right away. The submit request and
+    the operation-location polling all run as coroutines on a single
+    background loop, so a waiting generation costs a coroutine rather than a
+    blocked thread. At most max_concurrent generations run at once.
+    """
+
+    def __init__(self, max_concurrent=4, poll_timeout=120, job_ttl=3600):
+        """
+        :param int max_concurrent: Maximum generations running at once
+        :param float poll_timeout: Seconds to wait for a generation before giving up
+        :param float job_ttl: Seconds a finished job stays available to get
+        """
+        self.max_concurrent = max_concurrent
+        self.poll_timeout = poll_timeout
+        self.job_ttl = job_ttl
+        self.jobs = {}
+        self.loop = None
+        self.client = None
+        self.semaphore = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start the background event loop, if it is not running yet."""
+        with self.lock:
+            if self.loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True).start()
+            asyncio.run_coroutine_threadsafe(self.setup(), loop).result()
+            self.loop = loop
+
+    async def setup(self):
+        self.client = httpx.AsyncClient(timeout=http_clients.get_timeout(),
+                                        **http_clients.transport_options('aoai'))
+        self.semaphore = asyncio.Semaphore(self.max_concurrent)
+
+    def submit(self, prompt, on_done=None):
+        """Queue an image generation.
+
+        :param str prompt: Prompt to generate the image from
+        :param on_done: Optional callable receiving the finished job dict, run on a thread pool
+        :return tuple: (job id, concurrent.futures.Future resolving to the finished job dict)
+        :raise resilience.UpstreamUnavailableError: When Azure OpenAI is failing, checked up front
+        """
+        if resilience.get_upstream('aoai').breaker.state == 'open' \
+                and generated_images.get_cached_result(prompt) is None:
+            raise resilience.UpstreamUnavailableError('aoai is unavailable, failing fast.')
+        self.start()
+        self.prune()
+        job_id = uuid.uuid4().hex
+        self.jobs[job_id] = {'id': job_id, 'status': 'queued', 'prompt': prompt}
+        return job_id, asyncio.run_coroutine_threadsafe(self.run(job_id, on_done), self.loop)
+
+    def get(self, job_id):
+        """Get a job dict by id, None if unknown or expired.
+
+        The dict has a status of queued, running, succeeded or failed, and
+        either a result or an error once finished.
+        """
+        return self.jobs.get(job_id)
+
+    def prune(self):
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.get('finished_at', now) < now - self.job_ttl:
+                self.jobs.pop(job_id, None)
+
+    async def run(self, job_id, on_done):
+        job = self.jobs[job_id]
+        await self.run_generation(job)
+        job['finished_at'] = time.time()
+        if on_done is not None:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, on_done, job)
+            except Exception:
+                traceback.print_exc()
+        return job
+
+    async def run_generation(self, job):
+        """Answer a job from the prompt cache or by generating it, failing it on any error."""
+        try:
+            cached = generated_images.get_cached_result(job['prompt'])
+            if cached is not None:
+                job['result'] = cached
+            else:
+                async with self.semaphore:
+                    job['status'] = 'running'
+                    with metrics.timed('image_generation'):
+                        job['result'] = await self.generate(job['prompt'])
+                generated_images.cache_result(job['prompt'], job['result'])
+            job['status'] = 'succeeded'
+        except Exception as e:
+            job['error'] = str(e)
+            job['status'] = 'failed'
+            if isinstance(e, (ImageGenerationError, resilience.UpstreamError, httpx.HTTPError,
+                              OSError)):
+                print(f"Image generation failed: {e}")
+            else:
+                # e.g. an unexpected response body
+                traceback.print_exc()
+
+    async def generate(self, prompt):
+        """Submit a generation, poll it until it finishes and store the image.
+
+        :param str prompt: Prompt to generate the image from
+        :return dict: {'image_url': Azure image URL, 'file_path': stored file path,
+            'digest': content hash the image is stored and served under}
+        """
+        headers = {'api-key': config['aoai_key']}
+        url = (f"{config['aoai_endpoint'].rstrip('/')}/openai/images/generations:submit"
+               f"?api-version={API_VERSION}")
+        upstream = resilience.get_upstream('aoai')
+        response = await upstream.call_async(
+            lambda: self.client.post(url, headers=headers, json={'prompt': prompt}))
+        if response.status_code >= 400:
+            raise ImageGenerationError(f'{response.status_code} {response.text}')
+        operation_location_url = response.headers['operation-location']
+
+        deadline = time.monotonic() + self.poll_timeout
+        while True:
+            response = await upstream.call_async(
+                lambda: self.client.get(operation_location_url, headers=headers))
+            operation = response.json()
+            if operation.get('status') == 'succeeded':
+                break
+            if operation.get('status') == 'failed':
+                raise ImageGenerationError(operation.get('error', {}).get('message', 'failed'))
+            if time.monotonic() > deadline:
+                raise ImageGenerationError('Operation polling timed out.')
+            await asyncio.sleep(float(response.headers.get('retry-after') or 10))
+
+        image_url = operation['result']['data'][0]['url']  # extract image URL from response
+        response = await self.client.get(image_url)  # download the image
+        response.raise_for_status()
+        digest = await asyncio.to_thread(generated_images.store_image, response.content)
+        return {'image_url': image_url, 'file_path': generated_images.get_image_path(digest),
+                'digest': digest}
+
+
+image_jobs = ImageGenerationJobs(max_concurrent=config['image_generation_concurrency'],
+                                 poll_timeout=config['image_generation_timeout'])
 
 
 def generate_image_with_text(text):
-    generated_image = client.images.generate(prompt=text)
-    image_url = generated_image.data[0].url  # extract image URL from response
-
-    path = f'./downloads'
-    if not os.path.exists(path):
-        os.makedirs(path)
-    file_path = \
-        f"{path}/{datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')}.png"
-    results = requests.get(image_url).content  # download the image
-    with open(file_path, "wb") as image_file:
-        image_file.write(results)
-    response = {'image_url': image_url, 'file_path': file_path}
-    return response
+    """Generate an image and wait for it.
+
+    Prefer image_jobs.submit in request handlers, which does not block.
+
+    :param str text: Prompt
+    :return dict response: {'image_url': str, 'file_path': str, 'digest': str}
+    """
+    job_id, future = image_jobs.submit(text)
+    job = future.result()
+    if job['status'] != 'succeeded':
+        raise ImageGenerationError(job['error'])
+    return job['result']
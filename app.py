@@ -1,17 +1,37 @@
+import hmac
+import json
+import os
+import queue
+import signal
+import threading
+import time
+import traceback
+from concurrent import futures
 from pathlib import Path
+from urllib.parse import quote
 
 import uvicorn
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, HTTPException, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
-from linebot.v3 import WebhookHandler
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import Configuration, ApiClient, MessagingApi, ReplyMessageRequest, \
-    TextMessage, ImageMessage, QuickReply, MessageAction, QuickReplyItem
+    PushMessageRequest, TextMessage, ImageMessage, QuickReply, MessageAction, QuickReplyItem, \
+    ApiException
 from linebot.v3.webhooks import MessageEvent, TextMessageContent, FollowEvent, ImageMessageContent
+from pydantic import BaseModel
 
 import ai_vision
 import aoai
+import embedding_store
+import event_queue
+import generated_images
+import http_clients
+import image_previews
+import imagesets
+import metrics
+import resilience
+import session_store
 import utilities as utils
 
 app = FastAPI()
@@ -25,22 +45,305 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-config = utils.read_config()
-configuration = Configuration(access_token=config['line_channel_access_token'])
-handler = WebhookHandler(config['line_channel_secret'])
+config = utils.config
+configuration = Configuration(host=config['line_api_endpoint'],
+                              access_token=config['line_channel_access_token'])
+configuration.connection_pool_maxsize = http_clients.UPSTREAM_POOL_SIZES['line']
+api_client = ApiClient(configuration)
+line_bot_api = MessagingApi(api_client)
+events = event_queue.EventQueue(workers=config['event_workers'],
+                                max_size=config['event_queue_size'])
+profiler = metrics.Profiler(config['profile_sample_rate'], config['profile_path'])
+handler = event_queue.QueuedWebhookHandler(config['line_channel_secret'], events,
+                                           profiler=profiler)
+metrics.Gauge('linebot_event_queue_depth', 'Webhook events waiting for a worker.', events.qsize)
 
-config = utils.read_config()
-webhook_url = config['webhook_url']
-imageset_path = './example_imageset/'
-user_action = {}
+user_action = session_store.create_session_store(config)
+analysis_executor = futures.ThreadPoolExecutor(max_workers=config['analysis_workers'])
+batch_search_executor = futures.ThreadPoolExecutor(max_workers=config['batch_search_workers'])
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get('route')
+        path = route.path if route is not None else 'unmatched'
+        metrics.http_requests.inc(path, status)
+        metrics.http_seconds.observe(time.perf_counter() - start, path)
+
+
+@app.get("/metrics")
+def get_metrics():
+    """Metrics in the Prometheus text format."""
+    return Response(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
+@app.on_event("startup")
+def start_event_workers():
+    events.start()
+    if hasattr(signal, 'SIGHUP') and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGHUP, lambda signum, frame: utils.request_config_reload())
+    if config['warm_up']:
+        warm_up()
+
+
+def warm_up():
+    """Load the imageset index and open upstream connections before serving users.
+
+    Every step is best effort: a failing step is logged and skipped, and the
+    first request that needs it pays for it instead.
+    """
+    steps = [
+        *[(f'imageset {name}', lambda name=name: imagesets.load_index(name))
+          for name in imagesets.get_imagesets()],
+        ('vision SDK', ai_vision.get_service),
+        ('vision connection', lambda: http_clients.get_client('vision').head(config['vision_endpoint'])),
+        ('line connection', lambda: http_clients.get_client('line').head(config['line_data_endpoint'])),
+        ('image generation loop', aoai.image_jobs.start),
+    ]
+    for name, step in steps:
+        start = time.perf_counter()
+        try:
+            step()
+            print(f"Warmed up {name} in {time.perf_counter() - start:.2f}s")
+        except Exception as e:
+            print(f"Warm-up of {name} failed: {e!r}")
+
+
+@app.on_event("shutdown")
+def close_http_clients():
+    events.stop()
+    api_client.close()
+    http_clients.close_all()
+
+
+def send_reply(event, messages):
+    """Reply to an event, falling back to the push API once its reply token expired.
+
+    :param event: Webhook event to answer
+    :param list messages: Messages to send
+    """
+    with metrics.timed('reply'):
+        token_age = time.time() - event.timestamp / 1000
+        if event.reply_token is not None and token_age < config['reply_token_ttl']:
+            try:
+                line_bot_api.reply_message_with_http_info(
+                    ReplyMessageRequest(
+                        reply_token=event.reply_token,
+                        messages=messages
+                    )
+                )
+                return
+            except ApiException as e:
+                if e.status != 400:
+                    raise
+                print(f"Reply token rejected, pushing the message instead: {e.body}")
+        line_bot_api.push_message_with_http_info(
+            PushMessageRequest(
+                to=event_queue.get_push_target(event),
+                messages=messages
+            )
+        )
+
+
+IMAGE_CACHE_CONTROL = 'public, max-age=604800'
+
+
+def get_imageset_path(imageset):
+    """Get the path of an imageset, raising 404 if it is not configured."""
+    try:
+        return imagesets.get_imageset_path(imageset)
+    except imagesets.UnknownImagesetError:
+        raise HTTPException(status_code=404, detail="Imageset not found.")
+
+
+def get_imageset_file(imageset, image_name):
+    """Get the path of an imageset image, raising 404 for unknown or unsafe names.
+
+    Only image files are served, never the embedding store next to them.
+    """
+    if os.path.basename(image_name) != image_name or image_name.startswith('.') \
+            or not image_name.lower().endswith(embedding_store.IMAGE_EXTENSIONS):
+        raise HTTPException(status_code=404, detail="Image not found.")
+    image_path = Path(get_imageset_path(imageset), image_name)
+    if not image_path.is_file():
+        raise HTTPException(status_code=404, detail="Image not found.")
+    return image_path
+
+
+def get_image_urls(imageset, image_name):
+    """Get the original and preview URLs of an imageset image.
+
+    :param str imageset: Imageset name
+    :param str image_name: Image file name
+    :return tuple: (original content url, preview image url)
+    """
+    base_url = f"{config['webhook_url']}/imagesets/{quote(imageset)}"
+    quoted_name = quote(image_name)
+    return f'{base_url}/images/{quoted_name}', f'{base_url}/previews/{quoted_name}'
 
 
 @app.get("/getimage/{image_name}")
-async def get_image(image_name: str):
-    image_path = Path(imageset_path + image_name)
-    if not image_path.exists():
+async def get_image(image_name: str, if_none_match: str = Header(None)):
+    # links sent before imagesets were configurable point at the default imageset
+    return await get_imageset_image(imagesets.get_default_imageset(), image_name, if_none_match)
+
+
+@app.get("/getpreview/{image_name}")
+async def get_preview(image_name: str, if_none_match: str = Header(None)):
+    return await get_imageset_preview(imagesets.get_default_imageset(), image_name, if_none_match)
+
+
+@app.get("/imagesets/{imageset}/images/{image_name}")
+async def get_imageset_image(imageset: str, image_name: str, if_none_match: str = Header(None)):
+    image_path = get_imageset_file(imageset, image_name)
+    etag = image_previews.get_file_etag(str(image_path))
+    headers = {'ETag': etag, 'Cache-Control': IMAGE_CACHE_CONTROL}
+    if image_previews.etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(image_path, headers=headers)
+
+
+@app.get("/imagesets/{imageset}/previews/{image_name}")
+async def get_imageset_preview(imageset: str, image_name: str, if_none_match: str = Header(None)):
+    get_imageset_file(imageset, image_name)
+    preview_path = image_previews.get_preview_path(get_imageset_path(imageset), image_name)
+    if not os.path.exists(preview_path):
+        return await get_imageset_image(imageset, image_name, if_none_match)
+    etag = image_previews.get_file_etag(preview_path)
+    headers = {'ETag': etag, 'Cache-Control': IMAGE_CACHE_CONTROL}
+    if image_previews.etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=image_previews.get_preview_content(preview_path),
+                    media_type='image/jpeg', headers=headers)
+
+
+GENERATED_IMAGE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def get_generated_image_urls(digest):
+    """Get the original and preview URLs of a generated image.
+
+    :param str digest: Content hash the image is stored under
+    :return tuple: (original content url, preview image url)
+    """
+    webhook_url = config['webhook_url']
+    return f'{webhook_url}/generated/{digest}.png', f'{webhook_url}/generated/{digest}/preview'
+
+
+def get_generated_file(digest, preview=False):
+    """Get the path of a stored generated image, raising 404 if it is unknown or evicted."""
+    try:
+        file_path = generated_images.get_image_path(digest, preview=preview)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Image not found.")
+    if not os.path.isfile(file_path):
         raise HTTPException(status_code=404, detail="Image not found.")
-    return FileResponse(image_path)
+    return file_path
+
+
+@app.get("/generated/{digest}.png")
+async def get_generated_image(digest: str, if_none_match: str = Header(None)):
+    # content-addressed, so the digest is a strong ETag and the file never changes
+    file_path = get_generated_file(digest)
+    generated_images.touch(digest)
+    headers = {'ETag': f'"{digest}"', 'Cache-Control': GENERATED_IMAGE_CACHE_CONTROL}
+    if image_previews.etag_matches(if_none_match, f'"{digest}"'):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(file_path, media_type='image/png', headers=headers)
+
+
+@app.get("/generated/{digest}/preview")
+async def get_generated_preview(digest: str, if_none_match: str = Header(None)):
+    try:
+        file_path = get_generated_file(digest, preview=True)
+    except HTTPException:
+        return await get_generated_image(digest, if_none_match)
+    headers = {'ETag': f'"{digest}-preview"', 'Cache-Control': GENERATED_IMAGE_CACHE_CONTROL}
+    if image_previews.etag_matches(if_none_match, f'"{digest}-preview"'):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(file_path, media_type='image/jpeg', headers=headers)
+
+
+class BatchSearchRequest(BaseModel):
+    texts: list[str] = []
+    vectors: list[list[float]] = []
+    n: int = 3
+    stream: bool = False
+    imageset: str | None = None
+
+
+BATCH_SEARCH_CHUNK_SIZE = 256
+
+
+def run_batch_search(imageset_index, texts, vectors, n):
+    """Search an imageset for many queries, yielding one result dict per query.
+
+    Queries are handled in chunks: the text embeddings of a chunk are fetched
+    concurrently on batch_search_executor, so a large batch never delays the
+    captioning of live uploads, then the whole chunk is scored with one
+    matrix-matrix product.
+
+    :param imageset_index: Index of the imageset to search
+    :param list texts: Text queries
+    :param list vectors: Vector queries
+    :param int n: Number of similar images per query
+    """
+    queries = [{'text': text} for text in texts] + \
+              [{'vector_index': i, 'vector': vector} for i, vector in enumerate(vectors)]
+    for start in range(0, len(queries), BATCH_SEARCH_CHUNK_SIZE):
+        chunk = queries[start:start + BATCH_SEARCH_CHUNK_SIZE]
+        text_futures = {i: batch_search_executor.submit(ai_vision.get_vectorize_text, query['text'])
+                        for i, query in enumerate(chunk) if 'text' in query}
+        results = [None] * len(chunk)
+        scored, query_vectors = [], []
+        for i, query in enumerate(chunk):
+            try:
+                query_vector = text_futures[i].result() if i in text_futures else query.pop('vector')
+            except Exception as e:
+                results[i] = {'query': query, 'error': str(e)}
+                continue
+            if len(query_vector) != imageset_index.dim:
+                results[i] = {'query': query, 'error': 'Vector dimension does not match the imageset.'}
+                continue
+            scored.append(i)
+            query_vectors.append(query_vector)
+        if query_vectors:
+            for i, matches in zip(scored, imageset_index.query_batch(query_vectors, n=n)):
+                results[i] = {'query': chunk[i],
+                              'matches': [{'image': image, 'similarity': similarity}
+                                          for image, similarity in matches]}
+        yield from results
+
+
+@app.post("/search/batch")
+def batch_search(search: BatchSearchRequest, x_api_key: str = Header(None)):
+    """Search an imageset for a batch of text and/or vector queries.
+
+    The default imageset is searched unless imageset is set. Requires the
+    X-API-Key header to match search_api_key, the endpoint is disabled while
+    search_api_key is empty. With stream set, results are sent as NDJSON, one
+    line per query, as soon as each chunk is scored.
+    """
+    if not config['search_api_key'] or x_api_key is None \
+            or not hmac.compare_digest(x_api_key, config['search_api_key']):
+        raise HTTPException(status_code=403, detail="Invalid API key.")
+    if len(search.texts) + len(search.vectors) > config['search_max_batch']:
+        raise HTTPException(status_code=413, detail="Too many queries in one batch.")
+    if not 0 < search.n <= 100:
+        raise HTTPException(status_code=422, detail="n must be between 1 and 100.")
+    imageset_index = ai_vision.load_imageset_index(get_imageset_path(search.imageset))
+    results = run_batch_search(imageset_index, search.texts, search.vectors, search.n)
+    if search.stream:
+        return StreamingResponse((json.dumps(result) + '\n' for result in results),
+                                 media_type='application/x-ndjson')
+    return {'results': list(results)}
 
 
 @app.post("/callback")
@@ -53,176 +356,235 @@ async def callback(request: Request):
     # get request body as text
     body = await request.body()
 
-    # handle webhook body
+    # verify webhook body and queue its events for the workers
     try:
         handler.handle(body.decode("utf-8"), signature)
     except InvalidSignatureError:
         print("Invalid signature. Please check your channel access token/channel secret.")
         raise HTTPException(status_code=400, detail="Invalid signature.")
+    except queue.Full:
+        print("Event queue is full, asking LINE to redeliver later.")
+        raise HTTPException(status_code=503, detail="Too many pending events.")
 
     return 'OK'
 
 
+def deliver_generated_image(user_id, push_target, job):
+    """Push a finished image generation job to the user who requested it.
+
+    :param str user_id: User who requested the image
+    :param str push_target: User, group or room id to push to
+    :param dict job: Finished job from aoai.image_jobs
+    """
+    user_action.compare_and_set(user_id, 'processing', None)
+    if job['status'] == 'succeeded':
+        image_url, preview_image_url = get_generated_image_urls(job['result']['digest'])
+        messages = [ImageMessage(original_content_url=image_url,
+                                 preview_image_url=preview_image_url)]
+    else:
+        messages = [TextMessage(text=f"Sorry, we couldn't generate your image, please try again later.")]
+    line_bot_api.push_message_with_http_info(
+        PushMessageRequest(
+            to=push_target,
+            messages=messages
+        )
+    )
+
+
+UPSTREAM_UNAVAILABLE_MESSAGE = f"Sorry, our AI service is busy right now, " \
+                               f"please try again in a minute."
+
+
+def wait_for_stage(future, stage, deadline):
+    """Wait for a pipeline stage, returning None if it failed or missed its deadline.
+
+    :param concurrent.futures.Future future: Running stage
+    :param str stage: Stage name, used in logs
+    :param float deadline: time.monotonic() value the stage must finish by
+    """
+    try:
+        return future.result(timeout=max(0, deadline - time.monotonic()))
+    except futures.TimeoutError:
+        print(f"Stage {stage} timed out.")
+    except resilience.UpstreamError as e:
+        print(f"Stage {stage} failed: {e}")
+    except Exception:
+        print(f"Stage {stage} failed.")
+        traceback.print_exc()
+    return None
+
+
+def analyze_uploaded_image(image_data, imageset):
+    """Caption an uploaded image and find its most similar image in an imageset.
+
+    The caption and the vectorize-then-search branches run in parallel, each
+    with its own timeout, so the user waits for the slower one instead of
+    both, and one failing branch does not fail the other.
+
+    :param bytes image_data: Uploaded image content
+    :param str imageset: Imageset name
+    :return tuple: (caption response or None, (image name, similarity) or None)
+    """
+    def find_similar_image():
+        image_vector = ai_vision.get_vectorize_image(image_data=image_data)
+        imageset_index = imagesets.load_index(imageset)
+        similar_images = utils.get_top_n_similar_images(image_vector, imageset_index, n=1)
+        return similar_images[0] if similar_images else None
+
+    start = time.monotonic()
+    caption_future = analysis_executor.submit(ai_vision.get_image_caption, image_data=image_data)
+    similar_future = analysis_executor.submit(find_similar_image)
+    analysis = wait_for_stage(caption_future, 'caption', start + config['caption_timeout'])
+    similar = wait_for_stage(similar_future, 'similarity', start + config['similarity_timeout'])
+    if analysis is not None and 'caption' not in analysis:
+        analysis = None
+    return analysis, similar
+
+
 @handler.add(MessageEvent, message=TextMessageContent)
 def handle_message(event):
     """Handle text message event."""
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        message_received = event.message.text
-        user_id = event.source.user_id
-        reply_token = event.reply_token
-
-        if message_received == "Analyze Image":
-            user_action[user_id] = 'analyze_image'
-            reply_message = f"Please upload ONE image you wished to analyze.\n" \
+    message_received = event.message.text
+    user_id = event.source.user_id
+    state = user_action.get(user_id)
+
+    if message_received == "Analyze Image":
+        user_action.set(user_id, 'analyze_image')
+        reply_message = f"Please upload ONE image you wished to analyze.\n" \
+                        f"Processing might take a while, please be patient for the result."
+        send_reply(event, [TextMessage(text=reply_message)])
+    elif message_received == "Generate Image":
+        user_action.set(user_id, 'generate_image')
+        reply_message = f"How would you like to generate the image?"
+        send_reply(event, [TextMessage(text=reply_message,
+                                       quick_reply=QuickReply(items=[QuickReplyItem(
+                                           action=MessageAction(
+                                               label="AI Imagination",
+                                               text="Generate image randomly with AI imagination")),
+                                           QuickReplyItem(
+                                               action=MessageAction(
+                                                   label="Find Similar Image",
+                                                   text="Find the most similar image")
+                                           )]))])
+    elif message_received == "Select Imageset":
+        current_imageset = imagesets.get_user_imageset(user_action, user_id)
+        reply_message = f"Which imageset would you like to search?\n" \
+                        f"You're searching {current_imageset} now."
+        # LINE allows at most 13 quick reply items with labels of up to 20 characters
+        send_reply(event, [TextMessage(text=reply_message,
+                                       quick_reply=QuickReply(items=[QuickReplyItem(
+                                           action=MessageAction(label=name[:20],
+                                                                text=f"Use imageset {name}"))
+                                           for name in list(imagesets.get_imagesets())[:13]]))])
+    elif message_received.startswith("Use imageset "):
+        imageset = message_received.removeprefix("Use imageset ").strip()
+        try:
+            imagesets.set_user_imageset(user_action, user_id, imageset)
+            reply_message = f"Similar images will now be searched in {imageset}."
+        except imagesets.UnknownImagesetError:
+            reply_message = f"There is no imageset called {imageset}."
+        send_reply(event, [TextMessage(text=reply_message)])
+    elif state is not None:
+        if state == 'generate_image':
+            if message_received == 'Generate image randomly with AI imagination':
+                user_action.compare_and_set(user_id, state, 'generate_image_aoai')
+            elif message_received == 'Find the most similar image':
+                user_action.compare_and_set(user_id, state, 'find_similar_image')
+            reply_message = f"Now tell me more about this image!\n" \
                             f"Processing might take a while, please be patient for the result."
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[TextMessage(text=reply_message)]
-                )
-            )
-        elif message_received == "Generate Image":
-            user_action[user_id] = 'generate_image'
-            reply_message = f"How would you like to generate the image?"
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[TextMessage(text=reply_message,
-                                          quick_reply=QuickReply(items=[QuickReplyItem(
-                                              action=MessageAction(
-                                                  label="AI Imagination",
-                                                  text="Generate image randomly with AI imagination")),
-                                              QuickReplyItem(
-                                                  action=MessageAction(
-                                                      label="Find Similar Image",
-                                                      text="Find the most similar image")
-                                              )]))]
-                )
-            )
-        elif user_id in user_action:
-            if user_action[user_id] == 'generate_image':
-                if message_received == 'Generate image randomly with AI imagination':
-                    user_action[user_id] = 'generate_image_aoai'
-                elif message_received == 'Find the most similar image':
-                    user_action[user_id] = 'find_similar_image'
-                reply_message = f"Now tell me more about this image!\n" \
-                                f"Processing might take a while, please be patient for the result."
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=reply_token,
-                        messages=[TextMessage(text=reply_message)]
-                    )
-                )
-            elif user_action[user_id] == 'generate_image_aoai':
-                user_action[user_id] = 'processing'
-                image_url = aoai.generate_image_with_text(message_received)['image_url']
-                user_action.pop(user_id)
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=reply_token,
-                        messages=[ImageMessage(original_content_url=image_url,
-                                               preview_image_url=image_url)]
-                    )
-                )
-            elif user_action[user_id] == 'find_similar_image':
-                user_action[user_id] = 'processing'
+            send_reply(event, [TextMessage(text=reply_message)])
+        elif state == 'generate_image_aoai' \
+                and user_action.compare_and_set(user_id, state, 'processing'):
+            push_target = event_queue.get_push_target(event)
+            try:
+                aoai.image_jobs.submit(
+                    message_received,
+                    on_done=lambda job: deliver_generated_image(user_id, push_target, job))
+            except resilience.UpstreamUnavailableError as e:
+                print(e)
+                user_action.compare_and_set(user_id, 'processing', None)
+                send_reply(event, [TextMessage(text=UPSTREAM_UNAVAILABLE_MESSAGE)])
+                return
+            reply_message = f"Your image is being generated, " \
+                            f"we'll send it to you as soon as it's ready."
+            send_reply(event, [TextMessage(text=reply_message)])
+        elif state == 'find_similar_image' \
+                and user_action.compare_and_set(user_id, state, 'processing'):
+            try:
                 text_vector = ai_vision.get_vectorize_text(message_received)
-                imageset_vector = ai_vision.vectorize_imageset(imageset_path)
-                similar_images = utils.get_top_n_similar_images(text_vector, imageset_vector, n=1)
-                similar_image, similarity = similar_images[0]
-                similar_image_url = f'{webhook_url}/getimage/{similar_image}'.replace(' ', '%20')
-                user_action.pop(user_id)
-                reply_message = f"Top similar image: {similar_image}\n" \
-                                f"Similarity: {similarity}"
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=reply_token,
-                        messages=[TextMessage(text=reply_message),
-                                  ImageMessage(original_content_url=similar_image_url,
-                                               preview_image_url=similar_image_url)]
-                    )
-                )
-            elif user_action[user_id] == 'processing':
-                reply_message = f"We're still processing your previous request, " \
-                                f"please wait for the result patiently."
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=reply_token,
-                        messages=[TextMessage(text=reply_message)]
-                    )
-                )
-        else:
-            reply_message = f"Please open the menu to select which service you want to use."
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[TextMessage(text=reply_message)]
-                )
-            )
+            except resilience.UpstreamError as e:
+                print(e)
+                user_action.compare_and_set(user_id, 'processing', None)
+                send_reply(event, [TextMessage(text=UPSTREAM_UNAVAILABLE_MESSAGE)])
+                return
+            imageset = imagesets.get_user_imageset(user_action, user_id)
+            imageset_index = imagesets.load_index(imageset)
+            similar_images = utils.get_top_n_similar_images(text_vector, imageset_index, n=1)
+            user_action.compare_and_set(user_id, 'processing', None)
+            if not similar_images:
+                reply_message = f"Sorry, there are no images to search right now, " \
+                                f"please try again later."
+                send_reply(event, [TextMessage(text=reply_message)])
+                return
+            similar_image, similarity = similar_images[0]
+            similar_image_url, preview_image_url = get_image_urls(imageset, similar_image)
+            reply_message = f"Top similar image: {similar_image}\n" \
+                            f"Similarity: {similarity}"
+            send_reply(event, [TextMessage(text=reply_message),
+                               ImageMessage(original_content_url=similar_image_url,
+                                            preview_image_url=preview_image_url)])
+        elif user_action.get(user_id) == 'processing':
+            reply_message = f"We're still processing your previous request, " \
+                            f"please wait for the result patiently."
+            send_reply(event, [TextMessage(text=reply_message)])
+    else:
+        reply_message = f"Please open the menu to select which service you want to use."
+        send_reply(event, [TextMessage(text=reply_message)])
 
 
 @handler.add(MessageEvent, message=ImageMessageContent)
 def handle_image(event):
     """Handle image message event."""
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        user_id = event.source.user_id
-        message_id = event.message.id
-        reply_token = event.reply_token
-    if user_id in user_action:
-        if user_action[user_id] == 'analyze_image':
-            user_action.pop(user_id)
-            image_path = utils.download_file_from_line(message_id, 'image')
-            analysis = ai_vision.get_image_caption(file_name=image_path)
-            image_vector = ai_vision.get_vectorize_image(image_path)
-            imageset_vector = ai_vision.vectorize_imageset('example_imageset')
-            similar_images = utils.get_top_n_similar_images(image_vector, imageset_vector, n=1)
-            similar_image, similarity = similar_images[0]
-            similar_image_url = f'{webhook_url}/getimage/{similar_image}'.replace(' ', '%20')
-            reply_message = f"Caption: {analysis['caption']}\n" \
-                            f"Confidence: {analysis['confidence']}\n" \
-                            f"Top similar image: {similar_image}\n" \
-                            f"Similarity: {similarity}"
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[TextMessage(text=reply_message),
-                              ImageMessage(original_content_url=similar_image_url,
-                                           preview_image_url=similar_image_url)]
-                )
-            )
-        elif user_action[user_id] == 'processing':
+    user_id = event.source.user_id
+    message_id = event.message.id
+    state = user_action.get(user_id)
+    if state is not None:
+        if state == 'analyze_image' and user_action.compare_and_set(user_id, state, None):
+            image_data = utils.download_content_from_line(message_id, 'image')
+            imageset = imagesets.get_user_imageset(user_action, user_id)
+            analysis, similar = analyze_uploaded_image(image_data, imageset)
+            if analysis is None and similar is None:
+                reply_message = f"Sorry, we couldn't analyze this image right now, please try again later."
+                send_reply(event, [TextMessage(text=reply_message)])
+                return
+            if analysis is not None:
+                reply_message = f"Caption: {analysis['caption']}\n" \
+                                f"Confidence: {analysis['confidence']}"
+            else:
+                reply_message = f"Caption: unavailable"
+            if similar is None:
+                send_reply(event, [TextMessage(text=reply_message)])
+                return
+            similar_image, similarity = similar
+            similar_image_url, preview_image_url = get_image_urls(imageset, similar_image)
+            reply_message += f"\nTop similar image: {similar_image}\n" \
+                             f"Similarity: {similarity}"
+            send_reply(event, [TextMessage(text=reply_message),
+                               ImageMessage(original_content_url=similar_image_url,
+                                            preview_image_url=preview_image_url)])
+        elif state == 'processing':
             reply_message = f"We're still processing your previous request, " \
                             f"please wait for the result patiently."
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[TextMessage(text=reply_message)]
-                )
-            )
+            send_reply(event, [TextMessage(text=reply_message)])
         else:
             reply_message = f"Please open the menu to select which service you want to use."
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[TextMessage(text=reply_message)]
-                )
-            )
+            send_reply(event, [TextMessage(text=reply_message)])
 
 
 @handler.add(FollowEvent)
 def handle_follow(event):
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        reply_token = event.reply_token
-        reply_message = f"Hello World!"
-        line_bot_api.reply_message_with_http_info(
-            ReplyMessageRequest(
-                reply_token=reply_token,
-                messages=[TextMessage(text=reply_message)]
-            )
-        )
+    reply_message = f"Hello World!"
+    send_reply(event, [TextMessage(text=reply_message)])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,176 @@
+"""End-to-end load generator for the bot.
+
+Starts the stub servers in-process and sends signed webhook events to a
+running bot, which must be configured to call the stubs (the config.yml values
+are printed at start-up) and share --secret as its line_channel_secret.
+
+Every flow first walks a fresh user through the menu, then times its final
+event from sending the webhook until the bot's answer reaches the stub LINE
+API:
+
+- text_search: Generate Image, Find the most similar image, then a prompt;
+- image_analysis: Analyze Image, then an uploaded image;
+- image_generation: Generate Image, AI Imagination, then a prompt, timed
+  until the generated image is pushed.
+
+Example, with the bot running on port 5000::
+
+    python -m benchmarks.load_generator --flows text_search image_analysis \\
+        --concurrency 16 --iterations 200
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import itertools
+import json
+import threading
+import time
+import uuid
+from concurrent import futures
+
+import httpx
+import numpy as np
+
+from benchmarks import stub_servers
+
+FLOWS = {
+    'text_search': [('text', 'Generate Image'), ('text', 'Find the most similar image'),
+                    ('text', 'a red sports car')],
+    'image_analysis': [('text', 'Analyze Image'), ('image', None)],
+    'image_generation': [('text', 'Generate Image'),
+                         ('text', 'Generate image randomly with AI imagination'),
+                         ('text', 'a watercolor painting of a lighthouse')],
+}
+message_ids = itertools.count(1)
+
+
+def create_event(user_id, kind, text):
+    """Create a webhook message event with a unique reply token.
+
+    :return tuple: (event dict, reply token)
+    """
+    reply_token = uuid.uuid4().hex
+    if kind == 'text':
+        message = {'id': str(next(message_ids)), 'type': 'text', 'quoteToken': 'q', 'text': text}
+    else:
+        message = {'id': str(next(message_ids)), 'type': 'image', 'quoteToken': 'q',
+                   'contentProvider': {'type': 'line'}}
+    event = {'type': 'message', 'mode': 'active', 'timestamp': int(time.time() * 1000),
+             'source': {'type': 'user', 'userId': user_id}, 'webhookEventId': uuid.uuid4().hex,
+             'deliveryContext': {'isRedelivery': False}, 'replyToken': reply_token,
+             'message': message}
+    return event, reply_token
+
+
+def sign(body, secret):
+    return base64.b64encode(hmac.new(secret.encode(), body, hashlib.sha256).digest()).decode()
+
+
+class LoadGenerator:
+    """Runs flows against the bot and collects their latencies."""
+
+    def __init__(self, client, bot_url, secret, stub, timeout=60):
+        """
+        :param httpx.Client client: Client used to send webhooks
+        :param str bot_url: URL of the bot's /callback route
+        :param str secret: LINE channel secret the bot verifies signatures with
+        :param stub_servers.StubServer stub: Running stub server
+        :param float timeout: Seconds to wait for the bot to answer an event
+        """
+        self.client = client
+        self.bot_url = bot_url
+        self.secret = secret
+        self.stub = stub
+        self.timeout = timeout
+        self.ack_latencies = []
+        self.lock = threading.Lock()
+
+    def send_event(self, user_id, kind, text):
+        """Send one event, returning its reply token and when it was sent."""
+        event, reply_token = create_event(user_id, kind, text)
+        body = json.dumps({'destination': 'benchmark', 'events': [event]}).encode()
+        start = time.monotonic()
+        response = self.client.post(self.bot_url, content=body,
+                                    headers={'X-Line-Signature': sign(body, self.secret),
+                                             'Content-Type': 'application/json'})
+        with self.lock:
+            self.ack_latencies.append(time.monotonic() - start)
+        response.raise_for_status()
+        return reply_token, start
+
+    def run_flow(self, flow):
+        """Walk a new user through a flow.
+
+        :return float: Seconds from sending the final event to the bot's answer
+        :raise TimeoutError: When the bot did not answer in time
+        """
+        user_id = f'U{uuid.uuid4().hex}'
+        steps = FLOWS[flow]
+        for kind, text in steps[:-1]:
+            reply_token, _ = self.send_event(user_id, kind, text)
+            if self.stub.wait_for_delivery(reply_token, self.timeout) is None:
+                raise TimeoutError(f'No reply to {text!r}')
+        kind, text = steps[-1]
+        reply_token, start = self.send_event(user_id, kind, text)
+        # generated images are pushed once ready, everything else is a reply
+        key = user_id if flow == 'image_generation' else reply_token
+        delivery = self.stub.wait_for_delivery(key, self.timeout)
+        if delivery is None:
+            raise TimeoutError(f'No answer to the {flow} flow')
+        return delivery[0] - start
+
+    def run(self, flow, iterations, concurrency):
+        """Run a flow iterations times on concurrency threads.
+
+        :return dict: Latencies of the finished flows, errors and wall time
+        """
+        latencies = []
+        errors = []
+        start = time.monotonic()
+        with futures.ThreadPoolExecutor(concurrency) as executor:
+            for future in futures.as_completed(
+                    [executor.submit(self.run_flow, flow) for _ in range(iterations)]):
+                try:
+                    latencies.append(future.result())
+                except (TimeoutError, httpx.HTTPError) as e:
+                    errors.append(str(e))
+        return {'latencies': latencies, 'errors': errors, 'elapsed': time.monotonic() - start}
+
+
+def summarize(name, latencies, elapsed=None):
+    """Format the percentiles of a set of latencies, and their throughput if elapsed is given."""
+    if not latencies:
+        return f'{name:<18} no successful samples'
+    p50, p95, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 95, 99])
+    summary = (f'{name:<18} n={len(latencies):<6} p50={p50:8.1f}ms p95={p95:8.1f}ms '
+               f'p99={p99:8.1f}ms')
+    if elapsed:
+        summary += f' rps={len(latencies) / elapsed:7.1f}'
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Send signed webhook load to the bot.')
+    parser.add_argument('--bot-url', default='http://127.0.0.1:5000/callback')
+    parser.add_argument('--secret', default='benchmark-secret',
+                        help="The bot's line_channel_secret")
+    parser.add_argument('--flows', nargs='+', choices=sorted(FLOWS), default=sorted(FLOWS))
+    parser.add_argument('--iterations', type=int, default=100, help='Flows run per flow type')
+    parser.add_argument('--concurrency', type=int, default=8, help='Users running at once')
+    parser.add_argument('--timeout', type=float, default=60)
+    stub_servers.add_arguments(parser)
+    args = parser.parse_args()
+
+    stub_server = stub_servers.create_server(args).start()
+    stub_servers.print_config(stub_server)
+    print(f"line_channel_secret: '{args.secret}'\n")
+    with httpx.Client(timeout=30, limits=httpx.Limits(max_connections=args.concurrency * 2)) as http:
+        generator = LoadGenerator(http, args.bot_url, args.secret, stub_server, timeout=args.timeout)
+        for flow_name in args.flows:
+            result = generator.run(flow_name, args.iterations, args.concurrency)
+            print(summarize(flow_name, result['latencies'], result['elapsed']))
+            if result['errors']:
+                print(f"{'':<18} {len(result['errors'])} failed, e.g. {result['errors'][0]}")
+        print(summarize('webhook ack', generator.ack_latencies))
+    print(f'Stub requests: {stub_server.requests}')
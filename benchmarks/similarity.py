@@ -0,0 +1,125 @@
+"""Microbenchmarks of the similarity search across imageset sizes.
+
+For every size a synthetic imageset is built from clusters of unit vectors,
+as real image embeddings cluster by subject, and queried with perturbed
+imageset vectors. Reported per size:
+
+- loop: the per-image get_cosine_similarity loop, only run on small sizes;
+- exact: ImageIndex.query, one matrix-vector product;
+- batch: ImageIndex.query_batch per query, with --batch queries at once;
+- ivf: IVFIndex.query at the default n_probe, with its recall@n against exact.
+
+Sizes whose matrix would exceed --max-memory are skipped. Run from the
+repository root::
+
+    python -m benchmarks.similarity --sizes 200 10000 1000000 --dtype float16
+"""
+import argparse
+import time
+
+import numpy as np
+
+import utilities as utils
+from image_index import ImageIndex, normalize_rows
+from ivf_index import IVFIndex, measure_recall
+
+LOOP_MAX_SIZE = 20000
+IVF_MIN_SIZE = 10000
+
+
+def create_index(size, dim, dtype, cluster_size=500, seed=0, chunk_size=65536):
+    """Create an ImageIndex of clustered unit vectors, generated in chunks to bound memory.
+
+    :rtype: ImageIndex
+    """
+    rng = np.random.default_rng(seed)
+    centers = normalize_rows(rng.standard_normal((max(1, size // cluster_size), dim),
+                                                 dtype=np.float32))
+    matrix = np.empty((size, dim), dtype=dtype)
+    for start in range(0, size, chunk_size):
+        rows = min(chunk_size, size - start)
+        noise = rng.standard_normal((rows, dim), dtype=np.float32) * (0.7 / np.sqrt(dim))
+        matrix[start:start + rows] = normalize_rows(
+            centers[rng.integers(len(centers), size=rows)] + noise)
+    return ImageIndex([f'image ({i}).jpg' for i in range(size)], matrix, normalized=True)
+
+
+def create_queries(index, count, seed=1):
+    """Create queries close to random imageset vectors, like real near-duplicate searches."""
+    rng = np.random.default_rng(seed)
+    rows = np.asarray(index.matrix[rng.choice(len(index), count)], dtype=np.float32)
+    return rows + rng.normal(scale=0.5 / np.sqrt(index.dim), size=rows.shape).astype(np.float32)
+
+
+def time_per_call(func, repeat):
+    """Get the mean milliseconds of func over repeat calls, after one warm-up call."""
+    func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def run_size(size, dim, dtype, n, queries, batch):
+    """Benchmark every search of one imageset size.
+
+    :return dict: Mean milliseconds per query of each search, and the IVF recall
+    """
+    index = create_index(size, dim, dtype)
+    query_vectors = create_queries(index, queries)
+    query_iter = iter(np.resize(np.arange(queries), 10 ** 6))
+    result = {}
+    if size <= LOOP_MAX_SIZE:
+        imageset_vector = dict(zip(index.image_names, np.asarray(index.matrix, dtype=np.float32)))
+
+        def loop():
+            query = query_vectors[next(query_iter)]
+            similarities = {name: utils.get_cosine_similarity(query, vector)
+                            for name, vector in imageset_vector.items()}
+            return sorted(similarities.items(), key=lambda item: item[1], reverse=True)[:n]
+
+        result['loop'] = time_per_call(loop, repeat=3)
+    result['exact'] = time_per_call(lambda: index.query(query_vectors[next(query_iter)], n),
+                                    repeat=queries)
+    batch_vectors = query_vectors[:batch]
+    result['batch'] = time_per_call(lambda: index.query_batch(batch_vectors, n),
+                                    repeat=max(1, queries // batch)) / len(batch_vectors)
+    if size >= IVF_MIN_SIZE:
+        start = time.perf_counter()
+        ivf = IVFIndex.build(index)
+        result['ivf_build_s'] = time.perf_counter() - start
+        recall = measure_recall(index, ivf, query_vectors, n=n)
+        result['ivf'] = recall['ann_ms']
+        result['ivf_recall'] = recall['recall']
+    return result
+
+
+def format_result(size, result):
+    columns = [f'{size:>9}']
+    for key in ('loop', 'exact', 'batch', 'ivf'):
+        columns.append(f'{key}={result[key]:9.3f}ms' if key in result else f'{key}={"-":>9}  ')
+    if 'ivf_recall' in result:
+        columns.append(f"recall={result['ivf_recall']:.3f} build={result['ivf_build_s']:.1f}s")
+    return ' '.join(columns)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the similarity search.')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[200, 1000, 10000, 100000, 1000000])
+    parser.add_argument('--dim', type=int, default=1024)
+    parser.add_argument('--dtype', choices=['float32', 'float16'], default='float32')
+    parser.add_argument('-n', type=int, default=10, help='Results per query')
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--batch', type=int, default=32, help='Queries per query_batch call')
+    parser.add_argument('--max-memory', type=float, default=4, help='GiB a matrix may take')
+    args = parser.parse_args()
+
+    print(f'dim={args.dim} dtype={args.dtype} n={args.n}, mean milliseconds per query')
+    for imageset_size in args.sizes:
+        matrix_bytes = imageset_size * args.dim * np.dtype(args.dtype).itemsize
+        if matrix_bytes > args.max_memory * 2 ** 30:
+            print(f'{imageset_size:>9} skipped, the matrix needs {matrix_bytes / 2 ** 30:.1f} GiB')
+            continue
+        print(format_result(imageset_size, run_size(imageset_size, args.dim, args.dtype, args.n,
+                                                    args.queries, args.batch)), flush=True)
@@ -0,0 +1,279 @@
+"""Local stand-ins for Azure AI Vision, Azure OpenAI and the LINE APIs.
+
+One threaded HTTP server answers every upstream the bot calls, with
+configurable latency and error injection per upstream group:
+
+- vision: ``retrieval:vectorizeImage``, ``retrieval:vectorizeText`` and
+  ``imageanalysis:analyze``. Vectors are derived from a hash of the input, so
+  the same image or text always gets the same vector;
+- line: message content download, reply and push. Every reply and push is
+  recorded, so a load generator can tell when the bot answered an event;
+- aoai: image generation submit, operation polling and the image download.
+
+Run ``python -m benchmarks.stub_servers`` from the repository root to serve
+them standalone; it prints the config.yml values pointing the bot at them.
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+VECTOR_DIM = 1024
+SAMPLE_IMAGE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'example_imageset')
+
+
+class UpstreamSettings:
+    """Latency and error injection of one upstream group."""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_status=429):
+        """
+        :param float latency: Mean seconds added to every response
+        :param float jitter: Maximum seconds randomly added to or removed from latency
+        :param float error_rate: Fraction of requests answered with error_status
+        :param int error_status: Status of injected errors, 429 responses carry Retry-After: 1
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+
+    def delay(self):
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+    def should_fail(self):
+        return random.random() < self.error_rate
+
+
+class StubServer(ThreadingHTTPServer):
+    """HTTP server answering as Azure AI Vision, Azure OpenAI and LINE."""
+
+    daemon_threads = True
+
+    def __init__(self, port=8900, vision=None, line=None, aoai=None, generation_time=2.0):
+        """
+        :param int port: Port to listen on, 0 picks a free one
+        :param UpstreamSettings vision: Azure AI Vision settings
+        :param UpstreamSettings line: LINE API settings
+        :param UpstreamSettings aoai: Azure OpenAI settings
+        :param float generation_time: Seconds an image generation stays running
+        """
+        super().__init__(('127.0.0.1', port), StubHandler)
+        self.settings = {'vision': vision or UpstreamSettings(),
+                         'line': line or UpstreamSettings(),
+                         'aoai': aoai or UpstreamSettings()}
+        self.generation_time = generation_time
+        self.operations = {}
+        self.deliveries = {}
+        self.condition = threading.Condition()
+        self.requests = {}
+        self.sample_image = load_sample_image()
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self):
+        """Serve on a background thread."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def count(self, route):
+        with self.condition:
+            self.requests[route] = self.requests.get(route, 0) + 1
+
+    def record_delivery(self, key, messages):
+        """Record a reply (keyed by reply token) or push (keyed by recipient)."""
+        with self.condition:
+            self.deliveries.setdefault(key, []).append((time.monotonic(), messages))
+            self.condition.notify_all()
+
+    def wait_for_delivery(self, key, timeout):
+        """Wait until a reply token was used or a recipient got a push.
+
+        :param str key: Reply token or push recipient
+        :param float timeout: Seconds to wait
+        :return tuple: (time.monotonic() of the delivery, messages), None on timeout
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while not self.deliveries.get(key):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            return self.deliveries[key].pop(0)
+
+    def config_values(self):
+        """Get the config.yml values pointing the bot at this server.
+
+        :rtype: dict
+        """
+        return {'vision_endpoint': f'{self.base_url}/',
+                'aoai_endpoint': self.base_url,
+                'line_api_endpoint': self.base_url,
+                'line_data_endpoint': self.base_url}
+
+
+def load_sample_image():
+    """Get the content served as every uploaded LINE image."""
+    if os.path.isdir(SAMPLE_IMAGE_DIR):
+        for name in sorted(os.listdir(SAMPLE_IMAGE_DIR)):
+            if name.lower().endswith(('.jpg', '.jpeg', '.png')):
+                with open(os.path.join(SAMPLE_IMAGE_DIR, name), 'rb') as f:
+                    return f.read()
+    return b'\xff\xd8\xff\xd9'
+
+
+def get_stub_vector(data):
+    """Get a deterministic unit vector for some input bytes."""
+    seed = int.from_bytes(hashlib.sha256(data).digest()[:8], 'little')
+    vector = np.random.default_rng(seed).standard_normal(VECTOR_DIM).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    routes = [
+        ('POST', re.compile(r'.*/computervision/retrieval:vectorizeImage'), 'vision', 'vectorize_image'),
+        ('POST', re.compile(r'.*/computervision/retrieval:vectorizeText'), 'vision', 'vectorize_text'),
+        ('POST', re.compile(r'.*/computervision/imageanalysis:analyze'), 'vision', 'analyze'),
+        ('GET', re.compile(r'/v2/bot/message/(?P<id>[^/]+)/content'), 'line', 'line_content'),
+        ('POST', re.compile(r'/v2/bot/message/reply'), 'line', 'line_reply'),
+        ('POST', re.compile(r'/v2/bot/message/push'), 'line', 'line_push'),
+        ('POST', re.compile(r'/openai/images/generations:submit'), 'aoai', 'aoai_submit'),
+        ('GET', re.compile(r'/openai/operations/images/(?P<id>[^/?]+)'), 'aoai', 'aoai_poll'),
+        ('GET', re.compile(r'/images/(?P<id>[^/]+)\.png'), 'aoai', 'aoai_image'),
+    ]
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def route(self, method):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        path = self.path.split('?', 1)[0]
+        for route_method, pattern, group, name in self.routes:
+            match = pattern.fullmatch(path)
+            if route_method != method or match is None:
+                continue
+            self.server.count(name)
+            settings = self.server.settings[group]
+            settings.delay()
+            if settings.should_fail():
+                headers = {'Retry-After': '1'} if settings.error_status == 429 else {}
+                return self.send(settings.error_status, {'error': {'message': 'Injected error'}},
+                                 headers)
+            return getattr(self, name)(body, **match.groupdict())
+        self.send(404, {'error': {'message': f'No stub for {method} {path}'}})
+
+    def send(self, status, body, headers=None, content_type='application/json'):
+        content = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def vectorize_image(self, body):
+        self.send(200, {'modelVersion': 'stub', 'vector': get_stub_vector(body)})
+
+    def vectorize_text(self, body):
+        text = json.loads(body)['text']
+        self.send(200, {'modelVersion': 'stub', 'vector': get_stub_vector(text.encode('utf8'))})
+
+    def analyze(self, body):
+        self.send(200, {'captionResult': {'text': 'a stub caption', 'confidence': 0.9},
+                        'modelVersion': 'stub', 'metadata': {'width': 640, 'height': 480}})
+
+    def line_content(self, body, id):
+        self.send(200, self.server.sample_image, content_type='image/jpeg')
+
+    def line_reply(self, body):
+        request = json.loads(body)
+        self.server.record_delivery(request['replyToken'], request['messages'])
+        self.send(200, {'sentMessages': [{'id': uuid.uuid4().hex, 'quoteToken': 'stub'}]})
+
+    def line_push(self, body):
+        request = json.loads(body)
+        self.server.record_delivery(request['to'], request['messages'])
+        self.send(200, {'sentMessages': [{'id': uuid.uuid4().hex, 'quoteToken': 'stub'}]})
+
+    def aoai_submit(self, body):
+        operation_id = uuid.uuid4().hex
+        self.server.operations[operation_id] = time.monotonic() + self.server.generation_time
+        self.send(202, {'id': operation_id, 'status': 'notRunning'},
+                  {'operation-location': f'{self.server.base_url}/openai/operations/images/'
+                                         f'{operation_id}?api-version=stub'})
+
+    def aoai_poll(self, body, id):
+        finishes_at = self.server.operations.get(id)
+        if finishes_at is None:
+            return self.send(404, {'error': {'message': 'Unknown operation'}})
+        if time.monotonic() < finishes_at:
+            return self.send(200, {'id': id, 'status': 'running'}, {'retry-after': '1'})
+        self.send(200, {'id': id, 'status': 'succeeded',
+                        'result': {'data': [{'url': f'{self.server.base_url}/images/{id}.png'}]}})
+
+    def aoai_image(self, body, id):
+        self.send(200, self.server.sample_image, content_type='image/png')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def add_arguments(parser):
+    """Add the stub server options to an argument parser."""
+    parser.add_argument('--stub-port', type=int, default=8900)
+    for group in ('vision', 'line', 'aoai'):
+        parser.add_argument(f'--{group}-latency', type=float, default=0.05,
+                            help=f'Mean seconds added to every {group} response')
+        parser.add_argument(f'--{group}-jitter', type=float, default=0.02)
+        parser.add_argument(f'--{group}-error-rate', type=float, default=0.0,
+                            help=f'Fraction of {group} requests answered with an error')
+        parser.add_argument(f'--{group}-error-status', type=int, default=429)
+    parser.add_argument('--generation-time', type=float, default=2.0,
+                        help='Seconds an image generation stays running')
+
+
+def create_server(args):
+    """Create a stub server from parsed add_arguments options.
+
+    :rtype: StubServer
+    """
+    settings = {group: UpstreamSettings(latency=getattr(args, f'{group}_latency'),
+                                        jitter=getattr(args, f'{group}_jitter'),
+                                        error_rate=getattr(args, f'{group}_error_rate'),
+                                        error_status=getattr(args, f'{group}_error_status'))
+                for group in ('vision', 'line', 'aoai')}
+    return StubServer(port=args.stub_port, generation_time=args.generation_time, **settings)
+
+
+def print_config(server):
+    print('Point the bot at the stubs with these config.yml values:')
+    for key, value in server.config_values().items():
+        print(f"{key}: '{value}'")
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description='Serve stub Azure and LINE APIs.')
+    add_arguments(argument_parser)
+    stub_server = create_server(argument_parser.parse_args())
+    print_config(stub_server)
+    try:
+        stub_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,147 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import httpx
+
+import http_clients
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# client errors caused by the key or endpoint rather than the image, fixed by config
+CONFIG_STATUS_CODES = (401, 403, 404)
+
+
+class VectorizeError(Exception):
+    """Raised when an image could not be vectorized after all retries."""
+
+
+class ImageRejectedError(VectorizeError):
+    """Raised when the service rejected an image, retrying it cannot succeed."""
+
+
+class RateLimiter:
+    """Thread-safe limiter spacing calls evenly at a requests-per-second rate."""
+
+    def __init__(self, rate):
+        """
+        :param float rate: Maximum requests per second, 0 or None disables limiting
+        """
+        self.interval = 1 / rate if rate else 0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until the caller may send its next request."""
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def get_retry_delay(response, attempt, backoff):
+    """Get how long to wait before retrying, honoring a Retry-After header.
+
+    :param response: Failed response, None if the request itself failed
+    :param int attempt: Zero-based attempt number
+    :param float backoff: Base backoff in seconds
+    :return float: Delay in seconds
+    """
+    if response is not None:
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is not None and retry_after.isdigit():
+            return float(retry_after)
+    return backoff * 2 ** attempt * (1 + random.random() / 2)
+
+
+def vectorize_file(client, url, headers, image_path, limiter, max_retries=5, backoff=1.0):
+    """Vectorize one image file, retrying 429, 5xx and connection errors.
+
+    :param httpx.Client client: Client to send the request with
+    :param str url: vectorizeImage URL
+    :param dict headers: Request headers
+    :param str image_path: Image file path
+    :param RateLimiter limiter: Shared rate limiter
+    :param int max_retries: Retries before giving up
+    :param float backoff: Base backoff in seconds
+    :return list image_vector: Image vector
+    :raise ImageRejectedError: When the service answered a 4xx caused by the image
+    :raise VectorizeError: When the image could not be vectorized for another reason
+    """
+    with open(image_path, 'rb') as f:
+        image_data = f.read()
+    for attempt in range(max_retries + 1):
+        limiter.acquire()
+        response = None
+        try:
+            response = client.post(url=url, headers=headers, content=image_data)
+        except httpx.HTTPError as e:
+            error = str(e)
+        else:
+            if response.status_code == 200:
+                return response.json()['vector']
+            if response.status_code < 500 and response.status_code not in \
+                    RETRY_STATUS_CODES + CONFIG_STATUS_CODES:
+                raise ImageRejectedError(f'{response.status_code} {response.text}')
+            if response.status_code not in RETRY_STATUS_CODES:
+                raise VectorizeError(f'{response.status_code} {response.text}')
+            error = f'{response.status_code} {response.text}'
+        if attempt < max_retries:
+            time.sleep(get_retry_delay(response, attempt, backoff))
+    raise VectorizeError(f'Gave up after {max_retries + 1} attempts: {error}')
+
+
+def bulk_vectorize(imageset_path, image_names, endpoint, key, workers=4, rate=10,
+                   max_retries=5, checkpoint_every=20, on_checkpoint=None):
+    """Vectorize many imageset files concurrently.
+
+    Requests are spread over a bounded worker pool and spaced by a shared rate
+    limiter. The vectors completed since the previous checkpoint are handed to
+    on_checkpoint every checkpoint_every images and once at the end, so an
+    interrupted run only has to redo the images that were not checkpointed yet.
+
+    :param str imageset_path: Imageset path
+    :param list image_names: Image file names to vectorize
+    :param str endpoint: Azure AI Vision endpoint, may point at a local stub
+    :param str key: Azure AI Vision key
+    :param int workers: Concurrent requests
+    :param float rate: Maximum requests per second, 0 disables limiting
+    :param int max_retries: Retries per image before it is reported as failed
+    :param int checkpoint_every: Completed images between checkpoints
+    :param on_checkpoint: Optional callable receiving the {image name: vector} done since
+        the previous checkpoint
+    :return tuple: ({image name: vector}, {failed image name: exception})
+    """
+    url = (f'{endpoint}computervision/retrieval:vectorizeImage?api-version=2023-02-01'
+           f'-preview&modelVersion=latest')
+    headers = {'Content-type': 'application/octet-stream',
+               'Ocp-Apim-Subscription-Key': key}
+    limiter = RateLimiter(rate)
+    vectors = {}
+    failed = {}
+    client = http_clients.get_client('vision')
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(vectorize_file, client, url, headers,
+                                   f'{imageset_path}/{image}', limiter, max_retries): image
+                   for image in image_names}
+        since_checkpoint = {}
+        for future in as_completed(futures):
+            image = futures[future]
+            try:
+                vectors[image] = future.result()
+            except (VectorizeError, OSError, KeyError, ValueError) as e:
+                failed[image] = e
+                print(f'Failed to vectorize image: {image} ({e})')
+                continue
+            print(f'Vectorize image: {image} ({len(vectors)}/{len(image_names)})')
+            since_checkpoint[image] = vectors[image]
+            if on_checkpoint is not None and len(since_checkpoint) >= checkpoint_every:
+                on_checkpoint(since_checkpoint)
+                since_checkpoint = {}
+    if on_checkpoint is not None and since_checkpoint:
+        on_checkpoint(since_checkpoint)
+    return vectors, failed
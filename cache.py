@@ -0,0 +1,151 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread-safe in-memory LRU cache with an optional per-entry TTL."""
+
+    def __init__(self, max_entries=1024, ttl=None):
+        """
+        :param int max_entries: Maximum number of entries kept
+        :param float ttl: Seconds an entry stays valid, None keeps entries until evicted
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Get a cached value, None if missing or expired."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and entry[1] < time.time():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        """Cache a value, evicting the least recently used entries when full."""
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        """Get hit and miss counters.
+
+        :rtype: dict
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+
+class SqliteCache:
+    """Persistent key-value cache in a local sqlite file with TTL-based eviction.
+
+    Values must be JSON serializable. The file can be shared by several
+    processes on the same host.
+    """
+
+    purge_interval = 256
+
+    def __init__(self, path, ttl=7 * 24 * 3600):
+        """
+        :param str path: sqlite database file path
+        :param float ttl: Seconds an entry stays valid
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.ttl = ttl
+        self.connection = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+        self.connection.commit()
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Get a cached value, None if missing or expired."""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT value FROM cache WHERE key = ? AND expires >= ?',
+                (key, time.time())).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return json.loads(row[0])
+
+    def set(self, key, value):
+        """Cache a value, purging expired entries every purge_interval writes."""
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                (key, json.dumps(value), time.time() + self.ttl))
+            self.writes += 1
+            if self.writes % self.purge_interval == 0:
+                self.connection.execute('DELETE FROM cache WHERE expires < ?', (time.time(),))
+            self.connection.commit()
+
+    def stats(self):
+        """Get hit and miss counters.
+
+        :rtype: dict
+        """
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class TieredCache:
+    """In-memory LRU cache backed by an optional persistent cache."""
+
+    def __init__(self, memory, persistent=None):
+        """
+        :param LRUCache memory: First tier
+        :param SqliteCache persistent: Optional second tier, consulted on memory misses
+        """
+        self.memory = memory
+        self.persistent = persistent
+
+    def get(self, key):
+        """Get a cached value from the first tier holding it, None if none does."""
+        value = self.memory.get(key)
+        if value is None and self.persistent is not None:
+            value = self.persistent.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+        return value
+
+    def set(self, key, value):
+        """Cache a value in every tier."""
+        self.memory.set(key, value)
+        if self.persistent is not None:
+            self.persistent.set(key, value)
+
+    def stats(self):
+        """Get hit and miss counters of every tier.
+
+        :rtype: dict
+        """
+        stats = {'memory': self.memory.stats()}
+        if self.persistent is not None:
+            stats['persistent'] = self.persistent.stats()
+        return stats
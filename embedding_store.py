@@ -0,0 +1,325 @@
+"""Binary on-disk store for imageset embeddings.
+
+A store is two files next to the images:
+
+- ``imageset_embeddings.npy``: one contiguous, row-normalized float32 or float16
+  matrix, opened with mmap so several workers share a single page-cache copy.
+- ``imageset_embeddings.manifest.json``: the image file names, one per matrix row,
+  with the sha256, mtime and size each vector was computed from.
+
+While an imageset is being vectorized, completed vectors are appended to
+``imageset_embeddings.pending.jsonl`` rather than rewriting the store, so
+an interrupted run resumes from them and checkpoint writes grow linearly.
+
+Writers swap both files under an exclusive lock on ``imageset_embeddings.lock``
+and readers open them under a shared one, so a worker never pairs the matrix
+of one write with the manifest of another.
+
+Run ``python embedding_store.py <imageset_path>`` to convert an existing
+``imageset_embeddings.json`` cache into a store.
+"""
+import argparse
+import base64
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from image_index import ImageIndex
+
+STORE_VERSION = 1
+MATRIX_FILE = 'imageset_embeddings.npy'
+MANIFEST_FILE = 'imageset_embeddings.manifest.json'
+JSON_FILE = 'imageset_embeddings.json'
+LOCK_FILE = 'imageset_embeddings.lock'
+PENDING_FILE = 'imageset_embeddings.pending.jsonl'
+SUPPORTED_DTYPES = ('float32', 'float16')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')
+
+
+def store_exists(imageset_path):
+    """Check if an imageset has a binary embedding store.
+
+    :param str imageset_path: Imageset path
+    :rtype: bool
+    """
+    return (os.path.exists(os.path.join(imageset_path, MATRIX_FILE))
+            and os.path.exists(os.path.join(imageset_path, MANIFEST_FILE)))
+
+
+@contextlib.contextmanager
+def store_lock(imageset_path, exclusive):
+    """Hold the lock of an imageset store, a no-op where fcntl is unavailable.
+
+    :param str imageset_path: Imageset path
+    :param bool exclusive: Take the exclusive (writer) lock instead of the shared one
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(imageset_path, LOCK_FILE), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def write_temp_file(directory, name, content):
+    """Write content to a uniquely named temporary file next to name.
+
+    :param str directory: Directory to write in
+    :param str name: Name of the file the temporary file will replace
+    :param content: bytes, or a callable writing to the binary file it gets
+    :return str: Temporary file path
+    """
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f'{name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if callable(content):
+                content(f)
+            else:
+                f.write(content)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return temp_path
+
+
+def scan_imageset(imageset_path):
+    """List the image files of an imageset, skipping the store and other files.
+
+    :param str imageset_path: Imageset path
+    :return dict images: {image name: {'mtime': float, 'size': int}}
+    """
+    images = {}
+    with os.scandir(imageset_path) as entries:
+        for entry in entries:
+            if not entry.is_file() or not entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            stat = entry.stat()
+            images[entry.name] = {'mtime': stat.st_mtime, 'size': stat.st_size}
+    return images
+
+
+def file_sha256(file_path):
+    """Get the sha256 hex digest of a file.
+
+    :param str file_path: File path
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_metadata(imageset_path):
+    """Load the per-file metadata recorded in the store manifest of an imageset.
+
+    :param str imageset_path: Imageset path
+    :return dict metadata: {image name: {'sha256': str, 'mtime': float, 'size': int}},
+        entries migrated from a JSON cache carry no metadata
+    """
+    with open(os.path.join(imageset_path, MANIFEST_FILE), encoding='utf8') as f:
+        return get_manifest_metadata(json.load(f))
+
+
+def get_manifest_metadata(manifest):
+    return {image['name']: {key: value for key, value in image.items() if key != 'name'}
+            for image in manifest['images']}
+
+
+def diff_imageset(imageset_path, metadata):
+    """Compare the image files of an imageset against the metadata of its store.
+
+    A file whose mtime and size are unchanged is trusted without reading it,
+    otherwise its content hash decides whether the stored vector is still valid.
+    Entries without a recorded hash, e.g. migrated from a JSON cache, are trusted
+    and get their metadata filled in.
+
+    :param str imageset_path: Imageset path
+    :param dict metadata: Stored metadata, see load_metadata
+    :return tuple: (kept, changed), both {image name: metadata} dicts of current files;
+        kept vectors can be reused, changed ones must be vectorized
+    """
+    kept, changed = {}, {}
+    for name, stat in sorted(scan_imageset(imageset_path).items()):
+        previous = metadata.get(name)
+        if previous is not None and previous.get('mtime') == stat['mtime'] \
+                and previous.get('size') == stat['size'] and 'sha256' in previous:
+            kept[name] = previous
+            continue
+        current = {'sha256': file_sha256(os.path.join(imageset_path, name)), **stat}
+        if previous is not None and previous.get('sha256') in (None, current['sha256']):
+            kept[name] = current
+        else:
+            changed[name] = current
+    return kept, changed
+
+
+def merge_index(index, kept_names, new_vectors):
+    """Build an index from the reused rows of an index plus freshly computed vectors.
+
+    :param ImageIndex index: Previous index, may be None when kept_names is empty
+    :param list kept_names: Names of the rows of index to keep
+    :param dict new_vectors: {image name: vector} of new or changed images
+    :rtype: ImageIndex
+    """
+    new_index = ImageIndex.from_dict(new_vectors) if new_vectors else None
+    if not kept_names:
+        return new_index or ImageIndex.from_dict({})
+    positions = {name: i for i, name in enumerate(index.image_names)}
+    kept_matrix = np.asarray(index.matrix[[positions[name] for name in kept_names]],
+                             dtype=np.float32)
+    if new_index is None:
+        return ImageIndex(kept_names, kept_matrix, normalized=True)
+    return ImageIndex(kept_names + new_index.image_names,
+                      np.vstack([kept_matrix, new_index.matrix]), normalized=True)
+
+
+def save_index(imageset_path, index, dtype='float32', metadata=None):
+    """Write an index to the binary store of an imageset.
+
+    Both files are written to unique temporary paths first and then renamed
+    together under the store lock, so a reader never sees a half-written or
+    mismatched store, even with several workers writing the same imageset.
+
+    :param str imageset_path: Imageset path
+    :param ImageIndex index: Index to persist
+    :param str dtype: On-disk matrix dtype, float32 or float16
+    :param dict metadata: Optional {image name: {'sha256', 'mtime', 'size'}} to record
+    """
+    metadata = metadata or {}
+    if dtype not in SUPPORTED_DTYPES:
+        raise ValueError(f'Unsupported store dtype: {dtype}')
+    matrix_path = os.path.join(imageset_path, MATRIX_FILE)
+    manifest_path = os.path.join(imageset_path, MANIFEST_FILE)
+    manifest = {
+        'version': STORE_VERSION,
+        'dtype': dtype,
+        'dim': int(index.matrix.shape[1]),
+        'images': [{'name': name, **metadata.get(name, {})} for name in index.image_names],
+    }
+    matrix_temp = write_temp_file(
+        imageset_path, MATRIX_FILE,
+        lambda f: np.save(f, np.ascontiguousarray(index.matrix, dtype=dtype)))
+    try:
+        manifest_temp = write_temp_file(
+            imageset_path, MANIFEST_FILE,
+            json.dumps(manifest, ensure_ascii=False, indent=1).encode('utf8'))
+    except BaseException:
+        os.remove(matrix_temp)
+        raise
+    with store_lock(imageset_path, exclusive=True):
+        os.replace(matrix_temp, matrix_path)
+        os.replace(manifest_temp, manifest_path)
+
+
+def load_index(imageset_path, mmap=True):
+    """Load the index of an imageset from its binary store.
+
+    :param str imageset_path: Imageset path
+    :param bool mmap: Memory-map the matrix instead of reading it into memory
+    :rtype: ImageIndex
+    """
+    return load_store(imageset_path, mmap=mmap)[0]
+
+
+def load_store(imageset_path, mmap=True):
+    """Load the index of an imageset with the metadata of the same store write.
+
+    :param str imageset_path: Imageset path
+    :param bool mmap: Memory-map the matrix instead of reading it into memory
+    :return tuple: (ImageIndex, metadata), see load_metadata
+    """
+    with store_lock(imageset_path, exclusive=False):
+        with open(os.path.join(imageset_path, MANIFEST_FILE), encoding='utf8') as f:
+            manifest = json.load(f)
+        if manifest.get('version') != STORE_VERSION:
+            raise ValueError(f'Unsupported embedding store version: {manifest.get("version")}')
+        matrix = np.load(os.path.join(imageset_path, MATRIX_FILE),
+                         mmap_mode='r' if mmap else None)
+    image_names = [image['name'] for image in manifest['images']]
+    if matrix.shape[0] != len(image_names):
+        raise ValueError('Embedding store matrix does not match its manifest.')
+    return ImageIndex(image_names, matrix, normalized=True), get_manifest_metadata(manifest)
+
+
+def append_pending(imageset_path, vectors, metadata):
+    """Append freshly computed vectors to the pending file of an imageset.
+
+    :param str imageset_path: Imageset path
+    :param dict vectors: {image name: vector}
+    :param dict metadata: {image name: {'sha256', 'mtime', 'size'}} of at least the vectorized files
+    """
+    lines = []
+    for name, vector in vectors.items():
+        encoded = base64.b64encode(np.asarray(vector, dtype='<f4').tobytes()).decode('ascii')
+        lines.append(json.dumps({'name': name, **metadata[name], 'vector': encoded},
+                                ensure_ascii=False) + '\n')
+    with store_lock(imageset_path, exclusive=True):
+        with open(os.path.join(imageset_path, PENDING_FILE), 'a', encoding='utf8') as f:
+            f.write(''.join(lines))
+
+
+def load_pending(imageset_path):
+    """Load the vectors appended to the pending file of an imageset by an unfinished run.
+
+    A last line cut short by the interruption is skipped.
+
+    :param str imageset_path: Imageset path
+    :return dict: {image name: (metadata, vector)}
+    """
+    pending = {}
+    try:
+        with open(os.path.join(imageset_path, PENDING_FILE), encoding='utf8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                vector = np.frombuffer(base64.b64decode(entry.pop('vector')), dtype='<f4')
+                pending[entry.pop('name')] = (entry, vector)
+    except FileNotFoundError:
+        pass
+    return pending
+
+
+def remove_pending(imageset_path):
+    """Delete the pending file of an imageset once its vectors were saved to the store."""
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(os.path.join(imageset_path, PENDING_FILE))
+
+
+def convert_json_store(imageset_path, dtype='float32'):
+    """Convert the imageset_embeddings.json cache of an imageset into a binary store.
+
+    :param str imageset_path: Imageset path
+    :param str dtype: On-disk matrix dtype, float32 or float16
+    :rtype: ImageIndex
+    """
+    with open(os.path.join(imageset_path, JSON_FILE)) as f:
+        imageset_vector = json.load(f)
+    index = ImageIndex.from_dict(imageset_vector)
+    save_index(imageset_path, index, dtype=dtype)
+    return load_index(imageset_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert imageset_embeddings.json into a binary embedding store.')
+    parser.add_argument('imageset_path')
+    parser.add_argument('--dtype', choices=SUPPORTED_DTYPES, default='float32')
+    args = parser.parse_args()
+    converted = convert_json_store(args.imageset_path, dtype=args.dtype)
+    print(f'Converted {len(converted)} vectors into {args.imageset_path}/{MATRIX_FILE}')
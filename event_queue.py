@@ -0,0 +1,159 @@
+import collections
+import queue
+import threading
+import time
+import traceback
+
+from linebot.v3 import WebhookHandler
+from linebot.v3.webhooks import MessageEvent
+
+import metrics
+
+
+class EventQueue:
+    """Bounded queue of webhook events served by a pool of worker threads.
+
+    Every worker owns its own queue and events are routed to a worker by
+    key, so events of the same user are always handled one at a time and in
+    the order LINE delivered them.
+    """
+
+    def __init__(self, workers=8, max_size=256):
+        """
+        :param int workers: Number of worker threads
+        :param int max_size: Maximum number of queued events across all workers
+        """
+        self.queues = [queue.Queue(maxsize=max(1, max_size // workers)) for _ in range(workers)]
+        self.threads = []
+        self.submit_lock = threading.Lock()
+
+    def start(self):
+        """Start the worker threads."""
+        if self.threads:
+            return
+        for worker_queue in self.queues:
+            thread = threading.Thread(target=self.run_worker, args=(worker_queue,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """Let the workers finish the queued events and stop."""
+        for worker_queue in self.queues:
+            worker_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def submit(self, key, func, *args):
+        """Queue a call on the worker owning key.
+
+        :param str key: Ordering key, e.g. a user id
+        :param func: Callable to run on the worker
+        :raise queue.Full: When the worker queue is full
+        """
+        self.submit_all([(key, func, *args)])
+
+    def submit_all(self, calls):
+        """Queue several calls, either all of them or none.
+
+        :param list calls: (ordering key, callable, *args) tuples
+        :raise queue.Full: When a worker queue has no room for its calls, nothing is queued then
+        """
+        routed = [(self.queues[hash(key) % len(self.queues)], func, args)
+                  for key, func, *args in calls]
+        with self.submit_lock:
+            # workers only take items, so the room checked here cannot shrink before the puts
+            needed = collections.Counter(worker_queue for worker_queue, _, _ in routed)
+            for worker_queue, count in needed.items():
+                if worker_queue.maxsize - worker_queue.qsize() < count:
+                    raise queue.Full
+            queued_at = time.monotonic()
+            for worker_queue, func, args in routed:
+                worker_queue.put_nowait((func, args, queued_at))
+
+    def qsize(self):
+        """Get the number of events waiting to be handled."""
+        return sum(worker_queue.qsize() for worker_queue in self.queues)
+
+    @staticmethod
+    def run_worker(worker_queue):
+        while True:
+            item = worker_queue.get()
+            if item is None:
+                return
+            func, args, queued_at = item
+            metrics.stage_seconds.observe(time.monotonic() - queued_at, 'event_queue_wait')
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+
+
+class QueuedWebhookHandler(WebhookHandler):
+    """Webhook handler that verifies the signature right away and handles events on an EventQueue."""
+
+    def __init__(self, channel_secret, event_queue, profiler=None):
+        """
+        :param str channel_secret: Channel secret (as text)
+        :param EventQueue event_queue: Queue the events are handled on
+        :param metrics.Profiler profiler: Optional profiler sampling the handler calls
+        """
+        super().__init__(channel_secret)
+        self.event_queue = event_queue
+        self.profiler = profiler
+
+    def handle(self, body, signature):
+        """Verify a webhook and queue its events.
+
+        :param str body: Webhook request body (as text)
+        :param str signature: X-Line-Signature value (as text)
+        :raise InvalidSignatureError: When the signature does not match
+        :raise queue.Full: When the event queue has no room for every event, none is queued then
+        """
+        payload = self.parser.parse(body, signature, as_payload=True)
+        # LINE redelivers the whole body after a 503, so queue all of its events or none
+        self.event_queue.submit_all([(get_ordering_key(event), self.dispatch, event)
+                                     for event in payload.events])
+
+    def dispatch(self, event):
+        """Call the handler added for an event, like WebhookHandler.handle does."""
+        func = None
+        name = event.__class__.__name__
+        if isinstance(event, MessageEvent):
+            name = f'{name}_{event.message.__class__.__name__}'
+            func = self._handlers.get(name)
+        if func is None:
+            func = self._handlers.get(event.__class__.__name__, self._default)
+        if func is None:
+            print(f'No handler of {event.__class__.__name__} and no default handler')
+            return
+        metrics.events_handled.inc(name)
+        with metrics.timed(f'handle_{name}'):
+            if self.profiler is not None:
+                self.profiler.run(name, func, event)
+            else:
+                func(event)
+
+
+def get_ordering_key(event):
+    """Get the key events are ordered by, the user who sent them when known.
+
+    :rtype: str
+    """
+    source = event.source
+    if source is None:
+        return ''
+    return getattr(source, 'user_id', None) or getattr(source, 'group_id', None) \
+        or getattr(source, 'room_id', None) or ''
+
+
+def get_push_target(event):
+    """Get where to push messages answering an event: its group or room, else the user.
+
+    :rtype: str
+    """
+    source = event.source
+    if source is None:
+        return ''
+    return getattr(source, 'group_id', None) or getattr(source, 'room_id', None) \
+        or getattr(source, 'user_id', None) or ''
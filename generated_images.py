@@ -0,0 +1,113 @@
+"""Content-addressed local store of images generated with Azure OpenAI.
+
+Azure only keeps a generated image for a limited time, so every generated
+image is saved as ``<sha256>.png`` under generated_image_path and served from
+the bot's own ``/generated`` route, whose links never expire. A JPEG preview
+is stored next to it when Pillow is installed. The least recently served
+images are deleted once the store grows past generated_image_max_mb.
+
+With generated_prompt_cache_size set, the image of a prompt is remembered and
+repeated prompts are answered from the store instead of generating again.
+"""
+import hashlib
+import io
+import os
+import re
+import threading
+
+import cache
+import image_previews
+import utilities as utils
+
+config = utils.config
+DIGEST_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+prompt_results = cache.LRUCache(max_entries=config['generated_prompt_cache_size']) \
+    if config['generated_prompt_cache_size'] else None
+store_lock = threading.Lock()
+
+
+def get_image_path(digest, preview=False):
+    """Get the path of a stored image or its preview.
+
+    :param str digest: sha256 hex digest of the image content
+    :param bool preview: Whether to get the preview path
+    :rtype: str
+    :raise ValueError: When digest is not a sha256 hex digest
+    """
+    if not DIGEST_PATTERN.fullmatch(digest):
+        raise ValueError(f'Invalid image digest: {digest}')
+    suffix = '.preview.jpg' if preview else '.png'
+    return os.path.join(config['generated_image_path'], f'{digest}{suffix}')
+
+
+def store_image(content):
+    """Store a generated image under its content hash, with its preview.
+
+    :param bytes content: PNG content
+    :return str: sha256 hex digest of the content
+    """
+    digest = hashlib.sha256(content).hexdigest()
+    image_path = get_image_path(digest)
+    with store_lock:
+        if not os.path.exists(config['generated_image_path']):
+            os.makedirs(config['generated_image_path'])
+        if not os.path.exists(image_path):
+            write_file(image_path, content)
+            preview = create_preview(content)
+            if preview is not None:
+                write_file(get_image_path(digest, preview=True), preview)
+            utils.prune_directory(config['generated_image_path'],
+                                  config['generated_image_max_mb'] * 1024 * 1024)
+    return digest
+
+
+def write_file(file_path, content):
+    with open(f'{file_path}.tmp', 'wb') as f:
+        f.write(content)
+    os.replace(f'{file_path}.tmp', file_path)
+
+
+def create_preview(content):
+    """Get a downscaled JPEG of an image, None without Pillow or if it cannot be read."""
+    if image_previews.Image is None:
+        return None
+    output = io.BytesIO()
+    try:
+        image_previews.save_preview(io.BytesIO(content), output)
+        return output.getvalue()
+    except OSError as e:
+        print(f'Failed to generate preview of a generated image: {e}')
+        return None
+
+
+def touch(digest):
+    """Mark a stored image as recently used, so eviction deletes it last.
+
+    :return bool: Whether the image is still stored
+    """
+    try:
+        os.utime(get_image_path(digest))
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def get_cached_result(prompt):
+    """Get the stored result of a previous generation of the same prompt.
+
+    :param str prompt: Prompt
+    :return dict: Generation result, None if disabled, unknown or evicted meanwhile
+    """
+    if prompt_results is None:
+        return None
+    result = prompt_results.get(utils.normalize_text(prompt))
+    if result is None or not touch(result['digest']):
+        return None
+    return result
+
+
+def cache_result(prompt, result):
+    """Remember the result of a prompt, if the prompt cache is enabled."""
+    if prompt_results is not None:
+        prompt_results.set(utils.normalize_text(prompt), result)
@@ -0,0 +1,77 @@
+"""Shared, pooled HTTP clients for every upstream the bot talks to.
+
+Each upstream gets one keep-alive connection pool, created on first use and
+reused by every call, so requests skip the TCP and TLS handshake. HTTP/2 is
+negotiated when the optional ``h2`` package is installed.
+"""
+import threading
+
+import httpx
+
+import utilities as utils
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+UPSTREAM_POOL_SIZES = {
+    'vision': 20,
+    'line': 10,
+    'aoai': 10,
+}
+
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_timeout():
+    """Get the request timeout configured for upstream calls.
+
+    :rtype: httpx.Timeout
+    """
+    config = utils.read_config()
+    return httpx.Timeout(config['http_read_timeout'], connect=config['http_connect_timeout'])
+
+
+def transport_options(upstream):
+    """Get the connection pool options of an upstream.
+
+    Also used to build custom transports, e.g. the Azure OpenAI one.
+
+    :param str upstream: Upstream name, one of UPSTREAM_POOL_SIZES
+    :rtype: dict
+    """
+    config = utils.read_config()
+    pool_size = UPSTREAM_POOL_SIZES[upstream]
+    return {
+        'http2': HTTP2_AVAILABLE and config['http2'],
+        'limits': httpx.Limits(max_connections=pool_size,
+                               max_keepalive_connections=pool_size,
+                               keepalive_expiry=config['http_keepalive_expiry']),
+    }
+
+
+def get_client(upstream):
+    """Get the shared client of an upstream, creating it on first use.
+
+    :param str upstream: Upstream name, one of UPSTREAM_POOL_SIZES
+    :rtype: httpx.Client
+    """
+    client = clients.get(upstream)
+    if client is None:
+        with clients_lock:
+            client = clients.get(upstream)
+            if client is None:
+                client = httpx.Client(timeout=get_timeout(), **transport_options(upstream))
+                clients[upstream] = client
+    return client
+
+
+def close_all():
+    """Close every shared client, e.g. on application shutdown."""
+    with clients_lock:
+        for client in clients.values():
+            client.close()
+        clients.clear()
@@ -0,0 +1,202 @@
+import heapq
+import itertools
+
+import numpy as np
+
+SCORE_CHUNK_SIZE = 8192
+
+
+class ImageIndex:
+    """In-memory similarity index over an imageset.
+
+    All image vectors are kept as one L2-normalized float32 matrix, so a
+    cosine similarity query is a single matrix-vector product followed by a
+    partial top-k selection. Already normalized float16 matrices, such as a
+    memory-mapped embedding store, are kept as-is and upcast one chunk of
+    rows at a time while scoring, so no float32 copy of the whole matrix is
+    ever made.
+    """
+
+    def __init__(self, image_names, vectors, normalized=False):
+        """
+        :param list image_names: Image file names, one per row of vectors
+        :param vectors: Image vectors, a 2-D array-like of shape (len(image_names), dim)
+        :param bool normalized: Whether the rows of vectors are already L2-normalized
+        """
+        matrix = np.asarray(vectors)
+        if matrix.ndim != 2 or matrix.shape[0] != len(image_names):
+            raise ValueError('vectors must be a 2-D matrix with one row per image.')
+        if not normalized:
+            matrix = normalize_rows(matrix.astype(np.float32))
+        elif matrix.dtype not in (np.float32, np.float16):
+            matrix = matrix.astype(np.float32)
+        self.image_names = list(image_names)
+        self.matrix = matrix
+
+    @classmethod
+    def from_dict(cls, imageset_vector):
+        """Build an index from an {image name: vector} dict.
+
+        :param dict imageset_vector: Imageset vector
+        :rtype: ImageIndex
+        """
+        image_names = list(imageset_vector)
+        if not image_names:
+            return cls([], np.empty((0, 0), dtype=np.float32), normalized=True)
+        return cls(image_names, [imageset_vector[name] for name in image_names])
+
+    def __len__(self):
+        return len(self.image_names)
+
+    @property
+    def dim(self):
+        return self.matrix.shape[1]
+
+    def query(self, target_vector, n=3):
+        """Get the top n most similar images of a vector.
+
+        :param list target_vector: Given vector, can be image vector or text vector
+        :param int n: Number of similar images, default is 3
+        :return list top_n_similar_images: (image name, similarity) tuples, most similar first
+        """
+        if len(self) == 0 or n <= 0:
+            return []
+        query = normalize_rows(np.asarray(target_vector, dtype=np.float32)[np.newaxis, :])
+        similarities = self.score(query)[0]
+        top = top_k_indices(similarities, n)
+        return [(self.image_names[i], float(similarities[i])) for i in top]
+
+    def query_batch(self, target_vectors, n=3):
+        """Get the top n most similar images of many vectors with one matrix-matrix product.
+
+        :param target_vectors: 2-D array-like, one query vector per row
+        :param int n: Number of similar images per query, default is 3
+        :return list: One list of (image name, similarity) tuples per query
+        """
+        queries = np.asarray(target_vectors, dtype=np.float32)
+        if len(self) == 0 or n <= 0:
+            return [[] for _ in range(queries.shape[0])]
+        similarities = self.score(normalize_rows(queries))
+        results = []
+        for row in similarities:
+            top = top_k_indices(row, n)
+            results.append([(self.image_names[i], float(row[i])) for i in top])
+        return results
+
+    def score(self, queries):
+        """Get the similarities of every image to normalized queries.
+
+        :param queries: 2-D float32 array, one L2-normalized query per row
+        :return: float32 array of shape (len(queries), len(self))
+        """
+        if self.matrix.dtype == np.float32:
+            return queries @ self.matrix.T
+        similarities = np.empty((queries.shape[0], len(self)), dtype=np.float32)
+        for start in range(0, len(self), SCORE_CHUNK_SIZE):
+            chunk = np.asarray(self.matrix[start:start + SCORE_CHUNK_SIZE], dtype=np.float32)
+            similarities[:, start:start + SCORE_CHUNK_SIZE] = queries @ chunk.T
+        return similarities
+
+
+class ShardedIndex:
+    """Index split into row shards that are scored in parallel.
+
+    numpy releases the GIL during the matrix products, so scoring the shards
+    on a thread pool uses several cores without copying the matrix into
+    worker processes. The top n of every shard are merged into one result.
+    """
+
+    def __init__(self, shards, executor):
+        """
+        :param list shards: Indexes (ImageIndex) holding disjoint sets of images
+        :param concurrent.futures.Executor executor: Executor the shards are scored on
+        """
+        self.shards = shards
+        self.executor = executor
+
+    @classmethod
+    def split(cls, index, shard_size, executor):
+        """Split an ImageIndex into shards of at most shard_size images.
+
+        The shards are views of the index matrix, nothing is copied.
+
+        :param ImageIndex index: Index to split
+        :param int shard_size: Maximum images per shard
+        :param concurrent.futures.Executor executor: Executor the shards are scored on
+        :rtype: ShardedIndex
+        """
+        shards = [ImageIndex(index.image_names[start:start + shard_size],
+                             index.matrix[start:start + shard_size], normalized=True)
+                  for start in range(0, len(index), shard_size)]
+        return cls(shards, executor)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    @property
+    def image_names(self):
+        return [name for shard in self.shards for name in shard.image_names]
+
+    @property
+    def dim(self):
+        return self.shards[0].dim
+
+    def query(self, target_vector, n=3):
+        """Get the top n most similar images of a vector across every shard.
+
+        :param list target_vector: Given vector, can be image vector or text vector
+        :param int n: Number of similar images, default is 3
+        :return list top_n_similar_images: (image name, similarity) tuples, most similar first
+        """
+        results = self.executor.map(lambda shard: shard.query(target_vector, n), self.shards)
+        return merge_top_k(list(results), n)
+
+    def query_batch(self, target_vectors, n=3):
+        """Get the top n most similar images of many vectors across every shard.
+
+        :param target_vectors: 2-D array-like, one query vector per row
+        :param int n: Number of similar images per query, default is 3
+        :return list: One list of (image name, similarity) tuples per query
+        """
+        queries = np.asarray(target_vectors, dtype=np.float32)
+        shard_results = list(self.executor.map(lambda shard: shard.query_batch(queries, n),
+                                                self.shards))
+        return [merge_top_k(results, n) for results in zip(*shard_results)]
+
+
+def merge_top_k(results, n):
+    """Merge several (name, similarity) lists sorted by similarity into the overall top n.
+
+    :param list results: Lists of (image name, similarity) tuples, most similar first
+    :param int n: Number of tuples to keep
+    :rtype: list
+    """
+    return list(itertools.islice(heapq.merge(*results, key=lambda match: match[1], reverse=True), n))
+
+
+def normalize_rows(matrix):
+    """L2-normalize every row of a matrix, leaving all-zero rows untouched.
+
+    :param matrix: 2-D float32 array
+    :return: Row-normalized copy of matrix
+    """
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def top_k_indices(scores, k):
+    """Get the indices of the k highest scores, highest first.
+
+    Uses argpartition so only the k selected scores are fully sorted.
+
+    :param scores: 1-D array of scores
+    :param int k: Number of indices to return
+    :return: Array of indices into scores
+    """
+    k = min(k, scores.shape[0])
+    if k < scores.shape[0]:
+        candidates = np.argpartition(scores, -k)[-k:]
+    else:
+        candidates = np.arange(scores.shape[0])
+    return candidates[np.argsort(scores[candidates])[::-1]]
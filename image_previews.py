@@ -0,0 +1,130 @@
+"""Preview variants of imageset images and HTTP caching helpers for serving them.
+
+Previews are small JPEGs generated at index time into a ``.previews`` folder
+inside the imageset, so LINE clients do not download the full image just to
+render a thumbnail. Generating them requires Pillow; without it the original
+image is served as its own preview.
+"""
+import hashlib
+import os
+
+import cache
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+PREVIEW_DIR = '.previews'
+PREVIEW_MAX_EDGE = 240
+PREVIEW_JPEG_QUALITY = 80
+
+file_etags = cache.LRUCache(max_entries=4096)
+preview_contents = cache.LRUCache(max_entries=512)
+
+
+def get_preview_path(imageset_path, image_name):
+    """Get where the preview of an imageset image is stored.
+
+    :param str imageset_path: Imageset path
+    :param str image_name: Image file name
+    :rtype: str
+    """
+    return os.path.join(imageset_path, PREVIEW_DIR, image_name)
+
+
+def save_preview(source, target):
+    """Save a downscaled JPEG preview of an image, requires Pillow.
+
+    :param source: Image file path or binary file object
+    :param target: Preview file path or binary file object
+    :raise OSError: When the image cannot be read or the preview written
+    """
+    with Image.open(source) as image:
+        image.thumbnail((PREVIEW_MAX_EDGE, PREVIEW_MAX_EDGE))
+        image.convert('RGB').save(target, format='JPEG', quality=PREVIEW_JPEG_QUALITY)
+
+
+def build_previews(imageset_path, image_names):
+    """Generate missing or outdated previews and delete those of removed images.
+
+    :param str imageset_path: Imageset path
+    :param list image_names: Image file names currently in the imageset
+    :return int: Number of previews generated
+    """
+    if Image is None:
+        return 0
+    preview_dir = os.path.join(imageset_path, PREVIEW_DIR)
+    if not os.path.exists(preview_dir):
+        os.makedirs(preview_dir)
+    generated = 0
+    for image_name in image_names:
+        image_path = os.path.join(imageset_path, image_name)
+        preview_path = get_preview_path(imageset_path, image_name)
+        if os.path.exists(preview_path) \
+                and os.path.getmtime(preview_path) >= os.path.getmtime(image_path):
+            continue
+        try:
+            save_preview(image_path, f'{preview_path}.tmp')
+            os.replace(f'{preview_path}.tmp', preview_path)
+            generated += 1
+        except OSError as e:
+            print(f'Failed to generate preview of {image_name}: {e}')
+    kept = set(image_names)
+    for preview_name in os.listdir(preview_dir):
+        if preview_name not in kept:
+            os.remove(os.path.join(preview_dir, preview_name))
+    if generated:
+        print(f'Generated {generated} preview(s)')
+    return generated
+
+
+def get_file_etag(file_path):
+    """Get a strong ETag of a file, computed from its content.
+
+    The hash is cached per path, mtime and size, so a file is only read
+    again after it changed.
+
+    :param str file_path: File path
+    :rtype: str
+    """
+    stat = os.stat(file_path)
+    key = (file_path, stat.st_mtime_ns, stat.st_size)
+    etag = file_etags.get(key)
+    if etag is None:
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        etag = f'"{digest.hexdigest()}"'
+        file_etags.set(key, etag)
+    return etag
+
+
+def get_preview_content(preview_path):
+    """Get the content of a preview file, served from memory after the first read.
+
+    :param str preview_path: Preview file path
+    :rtype: bytes
+    """
+    stat = os.stat(preview_path)
+    key = (preview_path, stat.st_mtime_ns, stat.st_size)
+    content = preview_contents.get(key)
+    if content is None:
+        with open(preview_path, 'rb') as f:
+            content = f.read()
+        preview_contents.set(key, content)
+    return content
+
+
+def etag_matches(if_none_match, etag):
+    """Check if an If-None-Match header value matches an ETag.
+
+    :param str if_none_match: If-None-Match header value, may be None
+    :param str etag: Current ETag
+    :rtype: bool
+    """
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip().removeprefix('W/') for candidate in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates
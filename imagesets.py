@@ -0,0 +1,78 @@
+"""Registry of the named imagesets users can search.
+
+Imagesets are configured as ``imagesets: {name: path}`` in config.yml, with
+``default_imageset`` naming the one used until a user picks another. Each
+user's choice is kept in the session store under ``imageset:<user id>``.
+"""
+import ai_vision
+import utilities as utils
+
+config = utils.config
+
+CHOICE_TTL = 30 * 24 * 3600
+
+
+class UnknownImagesetError(KeyError):
+    """Raised when an imageset name is not configured."""
+
+
+def get_imagesets():
+    """Get the configured imagesets.
+
+    :return dict: {imageset name: imageset path}
+    """
+    return dict(config['imagesets'])
+
+
+def get_default_imageset():
+    """Get the name of the imageset searched when a user has not picked one.
+
+    :rtype: str
+    """
+    return config['default_imageset'] or next(iter(config['imagesets']))
+
+
+def get_imageset_path(name=None):
+    """Get the path of an imageset.
+
+    :param str name: Imageset name, None for the default imageset
+    :rtype: str
+    :raise UnknownImagesetError: When no imageset has that name
+    """
+    name = name or get_default_imageset()
+    path = config['imagesets'].get(name)
+    if path is None:
+        raise UnknownImagesetError(name)
+    return path
+
+
+def load_index(name=None):
+    """Load the similarity index of an imageset, see ai_vision.load_imageset_index.
+
+    :param str name: Imageset name, None for the default imageset
+    :raise UnknownImagesetError: When no imageset has that name
+    """
+    return ai_vision.load_imageset_index(get_imageset_path(name))
+
+
+def get_user_imageset(session_store, user_id):
+    """Get the imageset a user searches, falling back to the default if theirs was removed.
+
+    :param session_store: Session store holding the users' choices
+    :param str user_id: User id
+    :rtype: str
+    """
+    name = session_store.get(f'imageset:{user_id}')
+    if name is None or name not in config['imagesets']:
+        return get_default_imageset()
+    return name
+
+
+def set_user_imageset(session_store, user_id, name):
+    """Remember the imageset a user picked.
+
+    :raise UnknownImagesetError: When no imageset has that name
+    """
+    if name not in config['imagesets']:
+        raise UnknownImagesetError(name)
+    session_store.set(f'imageset:{user_id}', name, ttl=CHOICE_TTL)
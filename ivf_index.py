@@ -0,0 +1,242 @@
+"""Approximate nearest neighbour (IVF) index for large imagesets.
+
+The normalized imageset vectors are partitioned with spherical k-means into
+``n_lists`` lists. A query only scores the images in the ``n_probe`` lists
+whose centroids are closest to it, so raising ``n_probe`` trades latency for
+recall. The index is persisted next to the embedding store as
+``imageset_embeddings.ivf.npz``.
+
+Run ``python ivf_index.py <imageset_path>`` to measure recall and latency
+against the exact search for a range of ``n_probe`` values.
+"""
+import argparse
+import hashlib
+import os
+import time
+
+import numpy as np
+
+import embedding_store
+from image_index import normalize_rows, top_k_indices
+
+IVF_FILE = 'imageset_embeddings.ivf.npz'
+
+
+class IVFIndex:
+    """Inverted-file index wrapping an ImageIndex."""
+
+    def __init__(self, index, centroids, list_offsets, list_ids, n_probe=8):
+        """
+        :param ImageIndex index: Exact index holding the image names and vectors
+        :param centroids: (n_lists, dim) normalized centroid matrix
+        :param list_offsets: (n_lists + 1,) offsets of every list into list_ids
+        :param list_ids: Row ids of index, grouped by list
+        :param int n_probe: Lists scored per query, the recall/latency knob
+        """
+        self.index = index
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.n_probe = n_probe
+
+    @classmethod
+    def build(cls, index, n_lists=None, n_probe=8, iterations=10, seed=0):
+        """Partition an index with spherical k-means.
+
+        :param ImageIndex index: Exact index to partition
+        :param int n_lists: Number of lists, defaults to about sqrt(len(index))
+        :param int n_probe: Lists scored per query
+        :param int iterations: k-means iterations
+        :param int seed: Random seed
+        :rtype: IVFIndex
+        """
+        count = len(index)
+        n_lists = min(n_lists or max(1, int(np.sqrt(count))), count)
+        rng = np.random.default_rng(seed)
+        sample_size = min(count, n_lists * 64)
+        sample = np.asarray(index.matrix[np.sort(rng.choice(count, sample_size, replace=False))],
+                            dtype=np.float32)
+        centroids = sample[rng.choice(sample_size, n_lists, replace=False)]
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            order = np.argsort(assignments, kind='stable')
+            used, starts = np.unique(assignments[order], return_index=True)
+            sums = np.zeros_like(centroids)
+            sums[used] = np.add.reduceat(sample[order], starts, axis=0)
+            empty = ~sums.any(axis=1)
+            sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+            centroids = normalize_rows(sums)
+        assignments = assign_lists(index.matrix, centroids)
+        list_ids = np.argsort(assignments, kind='stable').astype(np.int32)
+        list_offsets = np.searchsorted(assignments[list_ids], np.arange(n_lists + 1))
+        return cls(index, centroids, list_offsets, list_ids, n_probe=n_probe)
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def image_names(self):
+        return self.index.image_names
+
+    @property
+    def dim(self):
+        return self.index.dim
+
+    def query(self, target_vector, n=3, n_probe=None):
+        """Get the approximate top n most similar images of a vector.
+
+        :param list target_vector: Given vector, can be image vector or text vector
+        :param int n: Number of similar images, default is 3
+        :param int n_probe: Lists to score, defaults to the index setting
+        :return list top_n_similar_images: (image name, similarity) tuples, most similar first
+        """
+        if len(self) == 0 or n <= 0:
+            return []
+        query = normalize_rows(np.asarray(target_vector, dtype=np.float32)[np.newaxis, :])[0]
+        n_probe = min(n_probe or self.n_probe, self.centroids.shape[0])
+        lists = top_k_indices(self.centroids @ query, n_probe)
+        candidates = np.concatenate(
+            [self.list_ids[self.list_offsets[i]:self.list_offsets[i + 1]] for i in lists])
+        if candidates.size == 0:
+            return []
+        candidates.sort()
+        similarities = self.index.matrix[candidates] @ query
+        top = top_k_indices(similarities, n)
+        return [(self.index.image_names[candidates[i]], float(similarities[i])) for i in top]
+
+    def query_batch(self, target_vectors, n=3):
+        """Get the approximate top n most similar images of many vectors.
+
+        :param target_vectors: 2-D array-like, one query vector per row
+        :param int n: Number of similar images per query, default is 3
+        :return list: One list of (image name, similarity) tuples per query
+        """
+        return [self.query(target_vector, n) for target_vector in target_vectors]
+
+    def save(self, imageset_path):
+        """Write the index next to the embedding store of an imageset.
+
+        :param str imageset_path: Imageset path
+        """
+        file_path = os.path.join(imageset_path, IVF_FILE)
+        fingerprint = get_fingerprint(imageset_path, self.index)
+        with open(f'{file_path}.tmp', 'wb') as f:
+            np.savez(f, centroids=self.centroids, list_offsets=self.list_offsets,
+                     list_ids=self.list_ids, fingerprint=np.array(fingerprint))
+        os.replace(f'{file_path}.tmp', file_path)
+
+    @classmethod
+    def load(cls, imageset_path, index, n_probe=8):
+        """Load the persisted index of an imageset.
+
+        :param str imageset_path: Imageset path
+        :param ImageIndex index: Exact index the IVF index was built from
+        :param int n_probe: Lists scored per query
+        :return: IVFIndex, None if there is none or it was built from other vectors
+        """
+        file_path = os.path.join(imageset_path, IVF_FILE)
+        if not os.path.exists(file_path):
+            return None
+        with np.load(file_path) as data:
+            if str(data['fingerprint']) != get_fingerprint(imageset_path, index):
+                return None
+            return cls(index, data['centroids'], data['list_offsets'], data['list_ids'],
+                       n_probe=n_probe)
+
+
+def assign_lists(matrix, centroids, chunk_size=65536):
+    """Get the closest centroid of every row, in chunks to bound memory.
+
+    :rtype: numpy.ndarray
+    """
+    assignments = np.empty(matrix.shape[0], dtype=np.int64)
+    for start in range(0, matrix.shape[0], chunk_size):
+        chunk = np.asarray(matrix[start:start + chunk_size], dtype=np.float32)
+        assignments[start:start + chunk_size] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+
+def get_fingerprint(imageset_path, index):
+    """Identify the embedding store an IVF index was built from.
+
+    Any rewrite of the store, e.g. by incremental re-indexing, changes it.
+
+    :param str imageset_path: Imageset path
+    :param ImageIndex index: Exact index
+    :rtype: str
+    """
+    matrix_path = os.path.join(imageset_path, embedding_store.MATRIX_FILE)
+    store_mtime = os.stat(matrix_path).st_mtime_ns if os.path.exists(matrix_path) else 0
+    digest = hashlib.sha256(str(store_mtime).encode())
+    for name in index.image_names:
+        digest.update(name.encode('utf8') + b'\0')
+    return f'{len(index)}:{index.dim if len(index) else 0}:{digest.hexdigest()}'
+
+
+def load_or_build(imageset_path, index, n_lists=None, n_probe=8):
+    """Load the IVF index of an imageset, building and saving it if missing or stale.
+
+    :param str imageset_path: Imageset path
+    :param ImageIndex index: Exact index of the imageset
+    :param int n_lists: Number of lists when building, see IVFIndex.build
+    :param int n_probe: Lists scored per query
+    :rtype: IVFIndex
+    """
+    ivf = IVFIndex.load(imageset_path, index, n_probe=n_probe)
+    if ivf is None:
+        start = time.perf_counter()
+        ivf = IVFIndex.build(index, n_lists=n_lists, n_probe=n_probe)
+        ivf.save(imageset_path)
+        print(f'Built IVF index with {ivf.centroids.shape[0]} lists '
+              f'in {time.perf_counter() - start:.1f}s')
+    return ivf
+
+
+def measure_recall(index, ivf, queries, n=10, n_probe=None):
+    """Measure recall@n and mean latency of an IVF index against the exact search.
+
+    :param ImageIndex index: Exact index
+    :param IVFIndex ivf: Approximate index
+    :param queries: Query vectors
+    :param int n: Results per query
+    :param int n_probe: Lists scored per query, defaults to the index setting
+    :return dict: {'recall', 'exact_ms', 'ann_ms'}
+    """
+    hits = 0
+    exact_time = 0
+    ann_time = 0
+    for query in queries:
+        start = time.perf_counter()
+        exact = {name for name, _ in index.query(query, n)}
+        exact_time += time.perf_counter() - start
+        start = time.perf_counter()
+        approximate = {name for name, _ in ivf.query(query, n, n_probe=n_probe)}
+        ann_time += time.perf_counter() - start
+        hits += len(exact & approximate)
+    return {
+        'recall': hits / (len(queries) * min(n, len(index))),
+        'exact_ms': exact_time / len(queries) * 1000,
+        'ann_ms': ann_time / len(queries) * 1000,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure IVF recall and latency of an imageset.')
+    parser.add_argument('imageset_path')
+    parser.add_argument('--lists', type=int, default=None)
+    parser.add_argument('--probes', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('-n', type=int, default=10)
+    args = parser.parse_args()
+
+    exact_index = embedding_store.load_index(args.imageset_path)
+    ivf_index = IVFIndex.build(exact_index, n_lists=args.lists)
+    rng = np.random.default_rng(1)
+    # perturbed imageset vectors stand in for real queries
+    rows = np.asarray(exact_index.matrix[rng.choice(len(exact_index), args.queries)], dtype=np.float32)
+    sample_queries = rows + rng.normal(scale=0.5 / np.sqrt(exact_index.dim), size=rows.shape)
+    print(f'{len(exact_index)} images, {ivf_index.centroids.shape[0]} lists')
+    for probe in args.probes:
+        result = measure_recall(exact_index, ivf_index, sample_queries, n=args.n, n_probe=probe)
+        print(f"n_probe={probe:<4} recall@{args.n}={result['recall']:.3f} "
+              f"exact={result['exact_ms']:.2f}ms ann={result['ann_ms']:.2f}ms")
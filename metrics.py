@@ -0,0 +1,233 @@
+"""Counters, histograms and stage timings rendered in the Prometheus text format.
+
+Stages of a request are timed with ``timed``::
+
+    with metrics.timed('vectorize_text'):
+        ...
+
+which records ``linebot_stage_duration_seconds{stage="vectorize_text"}`` and
+counts exceptions in ``linebot_stage_errors_total``. ``render`` produces the
+body of the ``/metrics`` route.
+"""
+import bisect
+import cProfile
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+registry = []
+caches = {}
+
+
+def format_labels(labelnames, labels):
+    if not labelnames:
+        return ''
+    pairs = ','.join(f'{name}="{escape(value)}"' for name, value in zip(labelnames, labels))
+    return '{' + pairs + '}'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Counter:
+    """Monotonically increasing value per label set."""
+
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        :param str name: Metric name
+        :param str documentation: Help text
+        :param tuple labelnames: Label names, values are passed to inc in this order
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        """Increase the value of a label set."""
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, format_labels(self.labelnames, labels), value)
+                    for labels, value in self.values.items()]
+
+
+class Gauge:
+    """Value read from a callable whenever metrics are rendered."""
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, func):
+        """
+        :param str name: Metric name
+        :param str documentation: Help text
+        :param func: Callable returning the current value
+        """
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+        registry.append(self)
+
+    def samples(self):
+        return [(self.name, '', self.func())]
+
+
+class Histogram:
+    """Distribution of observed values per label set, e.g. latencies in seconds."""
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """
+        :param str name: Metric name
+        :param str documentation: Help text
+        :param tuple labelnames: Label names, values are passed to observe in this order
+        :param tuple buckets: Sorted upper bounds of the buckets
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, *labels):
+        """Record a value for a label set."""
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # one count per bucket, the +Inf bucket, then the sum
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for labels, counts in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    samples.append((f'{self.name}_bucket', format_labels(
+                        self.labelnames + ('le',), labels + (bound,)), cumulative))
+                label_text = format_labels(self.labelnames, labels)
+                samples.append((f'{self.name}_sum', label_text, counts[-1]))
+                samples.append((f'{self.name}_count', label_text, cumulative))
+        return samples
+
+
+stage_seconds = Histogram('linebot_stage_duration_seconds', 'Duration of request stages.',
+                          ('stage',))
+stage_errors = Counter('linebot_stage_errors_total', 'Request stages that raised.', ('stage',))
+http_requests = Counter('linebot_http_requests_total', 'HTTP requests served.',
+                        ('route', 'status'))
+http_seconds = Histogram('linebot_http_request_duration_seconds', 'Duration of HTTP requests.',
+                         ('route',))
+events_handled = Counter('linebot_events_total', 'Webhook events handled.', ('event',))
+upstream_attempts = Counter('linebot_upstream_attempts_total',
+                            'Calls to upstream services by outcome.', ('upstream', 'outcome'))
+
+
+@contextmanager
+def timed(stage):
+    """Time a stage of a request, counting it as an error if it raises.
+
+    :param str stage: Stage name
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        stage_errors.inc(stage)
+        raise
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, stage)
+
+
+def register_cache(name, cache):
+    """Expose the hit, miss and size counters of a cache.
+
+    :param str name: Cache name, used as the cache label
+    :param cache: Any cache with a stats() method returning hits, misses and optionally entries
+    """
+    caches[name] = cache
+
+
+def cache_samples():
+    samples = {'hits': [], 'misses': [], 'entries': []}
+    for name, cache in caches.items():
+        stats = cache.stats()
+        for key, values in samples.items():
+            if key in stats:
+                values.append((format_labels(('cache',), (name,)), stats[key]))
+    return [('linebot_cache_hits_total', 'counter', 'Cache lookups answered from the cache.',
+             samples['hits']),
+            ('linebot_cache_misses_total', 'counter', 'Cache lookups that missed.',
+             samples['misses']),
+            ('linebot_cache_entries', 'gauge', 'Entries currently cached.', samples['entries'])]
+
+
+def render():
+    """Render every metric in the Prometheus text exposition format.
+
+    :rtype: str
+    """
+    lines = []
+    for metric in registry:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        lines.extend(f'{name}{labels} {value}' for name, labels, value in metric.samples())
+    for name, metric_type, documentation, samples in cache_samples():
+        lines.append(f'# HELP {name} {documentation}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        lines.extend(f'{name}{labels} {value}' for labels, value in samples)
+    return '\n'.join(lines) + '\n'
+
+
+class Profiler:
+    """Profiles a random sample of calls with cProfile.
+
+    Each sampled call is written to ``<directory>/<name>-<timestamp in ns>.prof``,
+    readable with ``python -m pstats`` or snakeviz. Only one call is profiled
+    at a time; calls sampled while another profile runs run unprofiled.
+    """
+
+    def __init__(self, sample_rate, directory='./profiles'):
+        """
+        :param float sample_rate: Fraction of calls to profile, 0 disables profiling
+        :param str directory: Directory the profiles are written to
+        """
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.lock = threading.Lock()
+
+    def run(self, name, func, *args):
+        """Call func(*args), profiling it if sampled.
+
+        :param str name: Name the profile file starts with
+        """
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate \
+                or not self.lock.acquire(blocking=False):
+            return func(*args)
+        try:
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(func, *args)
+            finally:
+                if not os.path.exists(self.directory):
+                    os.makedirs(self.directory)
+                profile.dump_stats(os.path.join(self.directory, f'{name}-{time.time_ns()}.prof'))
+        finally:
+            self.lock.release()
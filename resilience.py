@@ -0,0 +1,278 @@
+"""Adaptive concurrency limits, retries and circuit breakers for upstream calls.
+
+Every upstream (Azure AI Vision, Azure OpenAI) gets an ``Upstream`` holding:
+
+- an AIMD concurrency limit, raised by one slot per window of successful calls
+  and halved whenever the upstream answers 429, 5xx or times out;
+- retries with exponential backoff and jitter that honor ``Retry-After``;
+- a circuit breaker that, after repeated failures, fails calls immediately
+  with ``UpstreamUnavailableError`` until the upstream had time to recover.
+"""
+import asyncio
+import random
+import threading
+import time
+
+import httpx
+
+import metrics
+import utilities as utils
+
+OK = 'ok'
+RETRY = 'retry'
+
+
+class UpstreamError(Exception):
+    """Raised when an upstream call failed."""
+
+
+class UpstreamUnavailableError(UpstreamError):
+    """Raised when an upstream is unhealthy, so the call was not attempted or gave up."""
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit of one upstream."""
+
+    def __init__(self, initial=8, minimum=1, maximum=64):
+        """
+        :param int initial: Starting concurrency limit
+        :param int minimum: Lowest the limit can be decreased to
+        :param int maximum: Highest the limit can be increased to
+        """
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def try_acquire(self):
+        """Take a slot if one is free.
+
+        :rtype: bool
+        """
+        with self.condition:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self, timeout):
+        """Wait for a free slot.
+
+        :param float timeout: Seconds to wait
+        :raise UpstreamUnavailableError: When no slot freed up in time
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise UpstreamUnavailableError('Too many concurrent requests.')
+                self.condition.wait(remaining)
+            self.in_flight += 1
+
+    async def acquire_async(self, timeout):
+        """Wait for a free slot without blocking the event loop."""
+        deadline = time.monotonic() + timeout
+        while not self.try_acquire():
+            if time.monotonic() > deadline:
+                raise UpstreamUnavailableError('Too many concurrent requests.')
+            await asyncio.sleep(0.05)
+
+    def release(self, overloaded):
+        """Give a slot back and adapt the limit.
+
+        :param bool overloaded: Whether the upstream signalled overload, None to keep the limit
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if overloaded:
+                self.limit = max(self.minimum, self.limit / 2)
+            elif overloaded is not None:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class CircuitBreaker:
+    """Opens after consecutive failures and lets one trial call through after a cool-down."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        """
+        :param int failure_threshold: Consecutive failures that open the circuit
+        :param float reset_timeout: Seconds the circuit stays open before a trial call
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        """Check whether a call may go through.
+
+        :rtype: bool
+        """
+        with self.lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record(self, success):
+        """Record the outcome of a call."""
+        with self.lock:
+            self.trial_running = False
+            if success:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+
+def classify_response(response):
+    """Classify an httpx response for Upstream.call.
+
+    :return tuple: (OK or RETRY, Retry-After seconds or None)
+    """
+    if response.status_code == 429 or response.status_code >= 500:
+        retry_after = response.headers.get('Retry-After')
+        return RETRY, float(retry_after) if retry_after and retry_after.isdigit() else None
+    return OK, None
+
+
+class Upstream:
+    """Resilience policy of one upstream service."""
+
+    def __init__(self, name, max_retries=3, backoff=0.5, max_backoff=10, acquire_timeout=10,
+                 limiter=None, breaker=None):
+        """
+        :param str name: Upstream name, used in errors and logs
+        :param int max_retries: Retries after the first attempt
+        :param float backoff: Base backoff in seconds
+        :param float max_backoff: Longest wait between attempts
+        :param float acquire_timeout: Seconds to wait for a concurrency slot
+        :param AdaptiveLimiter limiter: Concurrency limiter
+        :param CircuitBreaker breaker: Circuit breaker
+        """
+        self.name = name
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.acquire_timeout = acquire_timeout
+        self.limiter = limiter or AdaptiveLimiter()
+        self.breaker = breaker or CircuitBreaker()
+
+    def get_delay(self, attempt, retry_after):
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        return min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+    def check_breaker(self):
+        """Give back the slot just taken and fail fast if the circuit does not allow a call.
+
+        :raise UpstreamUnavailableError: When the circuit is open
+        """
+        if not self.breaker.allow():
+            self.limiter.release(overloaded=None)
+            metrics.upstream_attempts.inc(self.name, 'rejected')
+            raise UpstreamUnavailableError(f'{self.name} is unavailable, failing fast.')
+
+    def record(self, outcome):
+        """Give back the slot of an attempt and record its outcome."""
+        self.limiter.release(overloaded=outcome != OK)
+        metrics.upstream_attempts.inc(self.name, outcome)
+        self.breaker.record(success=outcome == OK)
+
+    def call(self, func, classify=classify_response):
+        """Call an upstream with concurrency limiting, retries and the circuit breaker.
+
+        :param func: Callable performing one attempt and returning its result
+        :param classify: Callable mapping a result to (OK or RETRY, Retry-After or None)
+        :return: Result of the first attempt classified OK
+        :raise UpstreamUnavailableError: When the circuit is open, no concurrency slot freed
+            up or every attempt failed
+        """
+        error = None
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire(self.acquire_timeout)
+            self.check_breaker()
+            outcome, retry_after = RETRY, None
+            try:
+                result = func()
+                outcome, retry_after = classify(result)
+                error = f'{self.name} answered {getattr(result, "status_code", result)}'
+            except httpx.TransportError as e:
+                error = f'{self.name} request failed: {e!r}'
+            finally:
+                # any other exception also counts as a failure before it propagates
+                self.record(outcome)
+            if outcome == OK:
+                return result
+            if attempt < self.max_retries:
+                time.sleep(self.get_delay(attempt, retry_after))
+        raise UpstreamUnavailableError(error)
+
+    async def call_async(self, func, classify=classify_response):
+        """Async variant of call, func returns an awaitable."""
+        error = None
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire_async(self.acquire_timeout)
+            self.check_breaker()
+            outcome, retry_after = RETRY, None
+            try:
+                result = await func()
+                outcome, retry_after = classify(result)
+                error = f'{self.name} answered {getattr(result, "status_code", result)}'
+            except httpx.TransportError as e:
+                error = f'{self.name} request failed: {e!r}'
+            finally:
+                # any other exception also counts as a failure before it propagates
+                self.record(outcome)
+            if outcome == OK:
+                return result
+            if attempt < self.max_retries:
+                await asyncio.sleep(self.get_delay(attempt, retry_after))
+        raise UpstreamUnavailableError(error)
+
+
+def create_upstream(name):
+    """Create the resilience policy of an upstream from config.
+
+    :param str name: Upstream name
+    :rtype: Upstream
+    """
+    config = utils.read_config()
+    return Upstream(name, max_retries=config['upstream_max_retries'],
+                    limiter=AdaptiveLimiter(maximum=config['upstream_max_concurrency']),
+                    breaker=CircuitBreaker(failure_threshold=config['circuit_failure_threshold'],
+                                           reset_timeout=config['circuit_reset_timeout']))
+
+
+upstreams = {}
+upstreams_lock = threading.Lock()
+
+
+def get_upstream(name):
+    """Get the shared resilience policy of an upstream, creating it on first use.
+
+    :param str name: Upstream name, e.g. 'vision' or 'aoai'
+    :rtype: Upstream
+    """
+    with upstreams_lock:
+        if name not in upstreams:
+            upstreams[name] = create_upstream(name)
+        return upstreams[name]
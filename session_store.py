@@ -0,0 +1,171 @@
+"""Per-user conversation state, e.g. which menu flow a user is in.
+
+Two backends share one interface: ``MemorySessionStore`` keeps state in the
+process and suits a single worker, ``SqliteSessionStore`` keeps it in a local
+sqlite file so every uvicorn worker on the host sees the same state. Entries
+expire after a TTL, so abandoned or stuck flows clean themselves up.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+
+class MemorySessionStore:
+    """In-process session store."""
+
+    def __init__(self, ttl=1800):
+        """
+        :param float ttl: Default seconds an entry stays valid
+        """
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Get the state of a key, None if missing or expired."""
+        with self.lock:
+            return self.get_unlocked(key)
+
+    def set(self, key, value, ttl=None):
+        """Set the state of a key.
+
+        :param str key: Session key, e.g. a user id
+        :param str value: State
+        :param float ttl: Seconds the entry stays valid, defaults to the store TTL
+        """
+        with self.lock:
+            self.set_unlocked(key, value, ttl)
+
+    def delete(self, key):
+        """Delete the state of a key, if any."""
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def compare_and_set(self, key, expected, value, ttl=None):
+        """Set the state of a key only if it currently is expected.
+
+        :param str key: Session key
+        :param str expected: Required current state, None for no state
+        :param str value: New state, None deletes the entry
+        :param float ttl: Seconds the entry stays valid, defaults to the store TTL
+        :return bool: Whether the state was changed
+        """
+        with self.lock:
+            if self.get_unlocked(key) != expected:
+                return False
+            if value is None:
+                self.entries.pop(key, None)
+            else:
+                self.set_unlocked(key, value, ttl)
+            return True
+
+    def get_unlocked(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] < time.time():
+            del self.entries[key]
+            return None
+        return entry[0]
+
+    def set_unlocked(self, key, value, ttl):
+        self.entries[key] = (value, time.time() + (ttl if ttl is not None else self.ttl))
+        if len(self.entries) % 1024 == 0:
+            now = time.time()
+            for expired in [k for k, entry in self.entries.items() if entry[1] < now]:
+                del self.entries[expired]
+
+
+class SqliteSessionStore:
+    """Session store in a sqlite file, shared by every process on the host."""
+
+    def __init__(self, path, ttl=1800):
+        """
+        :param str path: sqlite database file path
+        :param float ttl: Default seconds an entry stays valid
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.ttl = ttl
+        self.connection = sqlite3.connect(path, timeout=10, check_same_thread=False,
+                                          isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+        self.lock = threading.Lock()
+        self.writes = 0
+
+    def get(self, key):
+        """Get the state of a key, None if missing or expired."""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT value FROM sessions WHERE key = ? AND expires >= ?',
+                (key, time.time())).fetchone()
+        return row[0] if row is not None else None
+
+    def set(self, key, value, ttl=None):
+        """Set the state of a key.
+
+        :param str key: Session key, e.g. a user id
+        :param str value: State
+        :param float ttl: Seconds the entry stays valid, defaults to the store TTL
+        """
+        with self.lock:
+            self.set_unlocked(key, value, ttl)
+
+    def delete(self, key):
+        """Delete the state of a key, if any."""
+        with self.lock:
+            self.connection.execute('DELETE FROM sessions WHERE key = ?', (key,))
+
+    def compare_and_set(self, key, expected, value, ttl=None):
+        """Set the state of a key only if it currently is expected.
+
+        The check and the write run in one immediate transaction, so two
+        processes can never both win the same transition.
+
+        :param str key: Session key
+        :param str expected: Required current state, None for no state
+        :param str value: New state, None deletes the entry
+        :param float ttl: Seconds the entry stays valid, defaults to the store TTL
+        :return bool: Whether the state was changed
+        """
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.connection.execute(
+                    'SELECT value FROM sessions WHERE key = ? AND expires >= ?',
+                    (key, time.time())).fetchone()
+                if (row[0] if row is not None else None) != expected:
+                    return False
+                if value is None:
+                    self.connection.execute('DELETE FROM sessions WHERE key = ?', (key,))
+                else:
+                    self.set_unlocked(key, value, ttl)
+                return True
+            finally:
+                self.connection.execute('COMMIT')
+
+    def set_unlocked(self, key, value, ttl):
+        now = time.time()
+        self.connection.execute(
+            'INSERT OR REPLACE INTO sessions (key, value, expires) VALUES (?, ?, ?)',
+            (key, value, now + (ttl if ttl is not None else self.ttl)))
+        self.writes += 1
+        if self.writes % 256 == 0:
+            self.connection.execute('DELETE FROM sessions WHERE expires < ?', (now,))
+
+
+def create_session_store(config):
+    """Create the session store selected in config.
+
+    :param dict config: Config, see utilities.read_config
+    :rtype: MemorySessionStore or SqliteSessionStore
+    """
+    if config['session_backend'] == 'sqlite':
+        return SqliteSessionStore(config['session_path'], ttl=config['session_ttl'])
+    if config['session_backend'] == 'memory':
+        return MemorySessionStore(ttl=config['session_ttl'])
+    raise ValueError(f"Unknown session_backend: {config['session_backend']}")
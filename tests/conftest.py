@@ -0,0 +1,22 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# the bot reads ./config.yml on import, so the tests run from a directory holding a test config
+TEST_CONFIG = """\
+webhook_url: 'http://127.0.0.1:5000'
+webhook_port: 5000
+vision_key: 'test'
+vision_endpoint: 'http://127.0.0.1:9/'
+aoai_key: 'test'
+aoai_endpoint: 'http://127.0.0.1:9'
+line_channel_access_token: 'test'
+line_channel_secret: 'test'
+"""
+
+config_dir = tempfile.mkdtemp(prefix='linebot-tests-')
+with open(os.path.join(config_dir, 'config.yml'), 'w', encoding='utf8') as config_file:
+    config_file.write(TEST_CONFIG)
+os.chdir(config_dir)
@@ -0,0 +1,25 @@
+import threading
+
+import ai_vision
+import resilience
+
+
+def test_caption_retries_do_not_hang(monkeypatch):
+    """Every attempt reads its own image buffer, the first one drains the buffer it reads."""
+    upstream = resilience.Upstream('vision', max_retries=2, backoff=0.01)
+    monkeypatch.setitem(resilience.upstreams, 'vision', upstream)
+    errors = []
+
+    def caption():
+        try:
+            ai_vision.get_image_caption(image_data=b'\xff\xd8\xff\xd9')
+        except resilience.UpstreamUnavailableError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=caption, daemon=True)
+    thread.start()
+    thread.join(timeout=20)
+    assert not thread.is_alive(), 'a retried caption attempt never returned'
+    assert len(errors) == 1
+    assert upstream.limiter.in_flight == 0
+    assert not upstream.breaker.trial_running
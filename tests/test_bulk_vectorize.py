@@ -0,0 +1,84 @@
+import os
+import shutil
+
+import pytest
+
+import ai_vision
+import bulk_vectorize
+import embedding_store
+from benchmarks import stub_servers
+
+EXAMPLE_IMAGESET = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'example_imageset')
+
+
+class FailFirst(stub_servers.UpstreamSettings):
+    """Answers the first failures requests with 429 and every later one normally."""
+
+    def __init__(self, failures):
+        super().__init__(error_status=429)
+        self.failures = failures
+
+    def should_fail(self):
+        self.failures -= 1
+        return self.failures >= 0
+
+
+@pytest.fixture
+def stub():
+    server = stub_servers.StubServer(port=0).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def imageset(tmp_path):
+    names = [f'image ({i}).jpg' for i in range(1, 6)]
+    for name in names:
+        shutil.copy(os.path.join(EXAMPLE_IMAGESET, name), tmp_path / name)
+    return str(tmp_path), names
+
+
+def vectorize(stub, imageset_path, names, **kwargs):
+    return bulk_vectorize.bulk_vectorize(imageset_path, names, f'{stub.base_url}/', 'key',
+                                         workers=2, rate=0, **kwargs)
+
+
+def test_throttled_requests_are_retried(stub, imageset):
+    stub.settings['vision'] = FailFirst(2)
+    vectors, failed = vectorize(stub, *imageset)
+    assert failed == {}
+    assert sorted(vectors) == sorted(imageset[1])
+    assert stub.requests['vectorize_image'] == len(imageset[1]) + 2
+
+
+def test_checkpoints_hand_over_new_vectors(stub, imageset):
+    checkpoints = []
+    vectors, _ = vectorize(stub, *imageset, checkpoint_every=2, on_checkpoint=checkpoints.append)
+    assert [len(checkpoint) for checkpoint in checkpoints] == [2, 2, 1]
+    assert {name: vector for checkpoint in checkpoints for name, vector in checkpoint.items()} \
+        == vectors
+
+
+def test_interrupted_run_resumes_from_checkpoints(stub, imageset, monkeypatch):
+    imageset_path, names = imageset
+    monkeypatch.setattr(ai_vision, 'config', {**ai_vision.config,
+                                              'vision_endpoint': f'{stub.base_url}/',
+                                              'vectorize_rate_limit': 0})
+    save_index = embedding_store.save_index
+
+    def interrupt(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(embedding_store, 'save_index', interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        ai_vision.vectorize_imageset(imageset_path)
+    assert sorted(embedding_store.load_pending(imageset_path)) == sorted(names)
+
+    monkeypatch.setattr(embedding_store, 'save_index', save_index)
+    index, failed = ai_vision.vectorize_imageset(imageset_path)
+    assert failed == 0
+    assert sorted(index.image_names) == sorted(names)
+    assert stub.requests['vectorize_image'] == len(names)
+    assert embedding_store.load_pending(imageset_path) == {}
@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+import resilience
+
+
+def create_upstream():
+    """Create an upstream whose circuit just opened and lets a trial call through at once."""
+    breaker = resilience.CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record(success=False)
+    return resilience.Upstream('test', max_retries=0, acquire_timeout=0.1,
+                               limiter=resilience.AdaptiveLimiter(initial=1), breaker=breaker)
+
+
+def fail():
+    raise ValueError('unexpected')
+
+
+def test_unexpected_error_during_trial_closes_it():
+    upstream = create_upstream()
+    assert upstream.breaker.state == 'half-open'
+    with pytest.raises(ValueError):
+        upstream.call(fail)
+    assert not upstream.breaker.trial_running
+    assert upstream.limiter.in_flight == 0
+    assert upstream.call(lambda: 'result', lambda result: (resilience.OK, None)) == 'result'
+    assert upstream.breaker.state == 'closed'
+
+
+def test_unexpected_error_during_async_trial_closes_it():
+    upstream = create_upstream()
+
+    async def fail_async():
+        fail()
+
+    async def succeed():
+        return 'result'
+
+    with pytest.raises(ValueError):
+        asyncio.run(upstream.call_async(fail_async))
+    assert not upstream.breaker.trial_running
+    assert upstream.limiter.in_flight == 0
+    result = asyncio.run(upstream.call_async(succeed, lambda result: (resilience.OK, None)))
+    assert result == 'result'
+
+
+def test_acquire_timeout_does_not_take_the_trial():
+    upstream = create_upstream()
+    upstream.limiter.acquire(timeout=0)
+    with pytest.raises(resilience.UpstreamUnavailableError):
+        upstream.call(fail)
+    upstream.limiter.release(overloaded=None)
+    assert not upstream.breaker.trial_running
+    assert upstream.call(lambda: 'result', lambda result: (resilience.OK, None)) == 'result'
@@ -1,13 +1,28 @@
 import datetime
-import math
 import os
 import sys
+import threading
+import time
+from collections.abc import Mapping
 from os.path import exists
+from types import MappingProxyType
 
-import requests
+import numpy as np
 import yaml
 from yaml import SafeLoader
 
+import http_clients
+import metrics
+from image_index import ImageIndex
+
+CONFIG_CHECK_INTERVAL = 2
+
+loaded_config = None
+loaded_config_mtime = None
+config_checked_at = 0
+reload_requested = False
+config_lock = threading.Lock()
+
 
 def config_file_generator():
     """Generate the template of config file"""
@@ -16,6 +31,8 @@ def config_file_generator():
 # | AzureAIVision Linebot            |
 # | Made by LD                       |
 # ++--------------------------------++
+# Changes to this file are picked up while the bot runs, send SIGHUP to skip the wait.
+# LINE credentials and pool, cache and worker sizes need a restart.
 
 # Paste your endpoint for the webhook here.
 # You can use ngrok to get a free static endpoint now!
@@ -25,18 +42,122 @@ webhook_url: ''
 # Port for the webhook to listen on. Default is 5000.
 # If you change this, make sure to change the port in your reverse proxy as well.
 webhook_port: 5000
+# API key for the POST /search/batch endpoint, sent in the X-API-Key header.
+# The endpoint is disabled while this is empty. search_max_batch caps the queries per request.
+# Text queries are embedded on batch_search_workers threads, apart from the live uploads.
+search_api_key: ''
+search_max_batch: 5000
+batch_search_workers: 4
+# Webhook events are acknowledged right away and handled by a pool of background workers.
+# Events of the same user are always handled in order. When more than event_queue_size events
+# are pending, LINE is asked to redeliver later.
+event_workers: 8
+event_queue_size: 256
+# Where each user's menu flow state is kept. 'memory' only works with a single uvicorn worker,
+# use 'sqlite' (stored at session_path) to run several workers on one host.
+# Abandoned flows are forgotten after session_ttl seconds.
+session_backend: 'memory'
+session_path: './cache/sessions.sqlite'
+session_ttl: 1800
+# Load the imageset index and open connections to Azure and LINE at startup, so the first
+# user request is not slowed down by them. Startup takes longer in exchange.
+warm_up: false
+# Seconds a reply token is trusted for, replies after that are sent with the push API instead.
+reply_token_ttl: 50
+# Uploaded images are captioned and searched in parallel on analysis_workers threads.
+# A stage taking longer than its timeout (in seconds) is left out of the reply.
+analysis_workers: 16
+caption_timeout: 20
+similarity_timeout: 20
+# Fraction of webhook handler calls profiled with cProfile, e.g. 0.01 for one in a hundred.
+# Profiles are written to profile_path, open them with 'python -m pstats <file>'. 0 disables it.
+# Request, stage timing, cache and queue metrics are always served on /metrics.
+profile_sample_rate: 0
+profile_path: './profiles'
+
+# Imagesets users can search, as name: folder. Users pick one from the menu with
+# 'Select Imageset', until then default_imageset is searched.
+imagesets:
+  example: './example_imageset/'
+default_imageset: 'example'
+# Imagesets larger than shard_size images are split into shards scored in parallel
+# on search_workers threads. Set shard_size to 0 to never split.
+shard_size: 100000
+search_workers: 4
 
 # Azure AI Vision API Key
 vision_key: ""
 vision_endpoint: ""
+# Concurrent requests and maximum requests per second used when vectorizing an imageset.
+# Lower the rate limit if your Azure AI Vision pricing tier keeps answering with 429.
+vectorize_workers: 4
+vectorize_rate_limit: 10
+# Approximate nearest neighbour search for large imagesets. When enabled, imagesets with at least
+# ann_min_images images are split into ann_lists partitions (0 picks about sqrt(images)) and
+# each query only scores the ann_probe closest partitions. Raise ann_probe for better recall,
+# lower it for speed. Run 'python ivf_index.py <imageset_path>' to measure the trade-off.
+ann_enabled: false
+ann_min_images: 20000
+ann_lists: 0
+ann_probe: 8
+# Text vectors are cached so repeated prompts skip Azure AI Vision.
+# text_cache_size is the number of prompts kept in memory. Set text_cache_path to a
+# sqlite file, e.g. './cache/text_vectors.sqlite', to also keep them on disk for
+# text_cache_ttl seconds. Leave it empty to only cache in memory.
+text_cache_size: 4096
+text_cache_path: ''
+text_cache_ttl: 604800
+# Captions and vectors of uploaded images are cached by content, so forwarded or re-sent
+# images are answered without calling Azure. Number of images kept and seconds each stays valid.
+image_cache_size: 1024
+image_cache_ttl: 86400
+# Uploaded images larger than image_max_edge pixels are downscaled and re-encoded as JPEG
+# at image_jpeg_quality before they are sent to Azure AI Vision. Requires Pillow
+# (pip install Pillow), set image_max_edge to 0 to always send the original image.
+image_max_edge: 1024
+image_jpeg_quality: 85
 
 # Azure OpenAI API Key
 aoai_key: ''
 aoai_endpoint: ''
+# Maximum image generations running at once, and seconds to wait for one before giving up.
+image_generation_concurrency: 4
+image_generation_timeout: 120
+# Generated images are kept under generated_image_path and served by the bot itself, the least
+# recently served ones are deleted past generated_image_max_mb megabytes.
+# Set generated_prompt_cache_size to remember that many prompts and answer a repeated prompt
+# with its earlier image instead of generating a new one. 0 always generates.
+generated_image_path: './generated'
+generated_image_max_mb: 1024
+generated_prompt_cache_size: 0
+
+# Outgoing HTTP connections are pooled and kept alive per upstream.
+# Timeouts are in seconds. HTTP/2 is used when the optional h2 package is installed.
+http_connect_timeout: 5
+http_read_timeout: 60
+http_keepalive_expiry: 120
+http2: true
+# Calls to Azure AI Vision and Azure OpenAI adapt their concurrency to the upstream, up to
+# upstream_max_concurrency, and are retried upstream_max_retries times on 429 and 5xx.
+# After circuit_failure_threshold failures in a row an upstream is considered down for
+# circuit_reset_timeout seconds, and users are told to try again later instead of waiting.
+upstream_max_concurrency: 32
+upstream_max_retries: 3
+circuit_failure_threshold: 5
+circuit_reset_timeout: 30
+
+# Keep a copy of every file downloaded from LINE under ./downloads.
+# Uploaded images are analyzed from memory either way.
+# The oldest copies are deleted once the folder grows past downloads_max_mb megabytes.
+save_downloads: false
+downloads_max_mb: 512
 
 # Line Channel Access Token & Secret
 line_channel_access_token: ""
 line_channel_secret: ""
+# LINE API hosts, only change these to point the bot at the benchmark stub servers.
+line_api_endpoint: 'https://api.line.me'
+line_data_endpoint: 'https://api-data.line.me'
 """
                    )
         file.close()
@@ -47,51 +168,202 @@ def read_config():
     """Read config file.
 
     Check if config file exists, if not, create one.
-    if exists, read config file and return config with dict type.
+    The file is parsed once into a read-only mapping shared by every caller.
+    It is read again when config.yml changed, checked at most every
+    CONFIG_CHECK_INTERVAL seconds, or when reload_config is called.
 
-    :rtype: dict
+    :rtype: types.MappingProxyType
     """
-    if not exists('./config.yml'):
-        print("Config file not found, create one by default.\nPlease finish filling config.yml")
-        with open('config.yml', 'w', encoding="utf8"):
-            config_file_generator()
+    global loaded_config, loaded_config_mtime, config_checked_at, reload_requested
+    if loaded_config is not None and time.monotonic() - config_checked_at < CONFIG_CHECK_INTERVAL:
+        return loaded_config
+    with config_lock:
+        if loaded_config is None:
+            if not exists('./config.yml'):
+                print("Config file not found, create one by default.\nPlease finish filling config.yml")
+                with open('config.yml', 'w', encoding="utf8"):
+                    config_file_generator()
+            try:
+                loaded_config_mtime = get_config_mtime()
+                loaded_config = load_config_file()
+            except (KeyError, TypeError, yaml.YAMLError):
+                print(
+                    "An error occurred while reading config.yml, please check if the file is corrected filled.\n"
+                    "If the problem can't be solved, consider delete config.yml and restart the program.\n")
+                sys.exit()
+            config_checked_at = time.monotonic()
+        elif time.monotonic() - config_checked_at >= CONFIG_CHECK_INTERVAL:
+            config_checked_at = time.monotonic()
+            if reload_requested or get_config_mtime() != loaded_config_mtime:
+                reload_requested = False
+                reload_config_unlocked()
+    return loaded_config
+
+
+def reload_config():
+    """Read config.yml again, keeping the current config if the file is invalid.
+
+    Settings read per request, e.g. Azure keys, endpoints, timeouts and feature
+    flags, take effect right away. LINE credentials and pool, cache and worker
+    sizes need a restart.
 
+    :return bool: Whether the new config was loaded
+    """
+    read_config()
+    with config_lock:
+        return reload_config_unlocked()
+
+
+def request_config_reload():
+    """Make the next read_config read config.yml again, safe to call from a signal handler."""
+    global config_checked_at, reload_requested
+    reload_requested = True
+    config_checked_at = 0
+
+
+def reload_config_unlocked():
+    global loaded_config, loaded_config_mtime
+    # recorded first, so an invalid file is not retried until it changes again
+    loaded_config_mtime = get_config_mtime()
     try:
-        with open('config.yml', encoding="utf8") as file:
-            data = yaml.load(file, Loader=SafeLoader)
-            config = {
-                'webhook_url': data['webhook_url'],
-                'webhook_port': data['webhook_port'],
-                'vision_key': data['vision_key'],
-                'vision_endpoint': data['vision_endpoint'],
-                'aoai_key': data['aoai_key'],
-                'aoai_endpoint': data['aoai_endpoint'],
-                'line_channel_access_token': data['line_channel_access_token'],
-                'line_channel_secret': data['line_channel_secret']
-            }
-            file.close()
-            return config
-    except (KeyError, TypeError):
-        print(
-            "An error occurred while reading config.yml, please check if the file is corrected filled.\n"
-            "If the problem can't be solved, consider delete config.yml and restart the program.\n")
-        sys.exit()
+        loaded_config = load_config_file()
+    except (KeyError, TypeError, OSError, yaml.YAMLError) as e:
+        print(f"Failed to reload config.yml, keeping the current config: {e!r}")
+        return False
+    print("Reloaded config.yml")
+    return True
 
 
-def download_file_from_line(message_id, message_type):
-    """Get file binary and save them in PC.
+def get_config_mtime():
+    try:
+        return os.stat('config.yml').st_mtime_ns
+    except FileNotFoundError:
+        return None
 
-    Use to download files from LINE.
+
+def load_config_file():
+    """Parse config.yml into a read-only mapping.
+
+    :rtype: types.MappingProxyType
+    :raise KeyError: When a required key is missing
+    """
+    with open('config.yml', encoding="utf8") as file:
+        data = yaml.load(file, Loader=SafeLoader)
+        config = {
+            'webhook_url': data['webhook_url'],
+            'webhook_port': data['webhook_port'],
+            'search_api_key': data.get('search_api_key', ''),
+            'search_max_batch': data.get('search_max_batch', 5000),
+            'batch_search_workers': data.get('batch_search_workers', 4),
+            'event_workers': data.get('event_workers', 8),
+            'event_queue_size': data.get('event_queue_size', 256),
+            'session_backend': data.get('session_backend', 'memory'),
+            'session_path': data.get('session_path', './cache/sessions.sqlite'),
+            'session_ttl': data.get('session_ttl', 1800),
+            'warm_up': data.get('warm_up', False),
+            'reply_token_ttl': data.get('reply_token_ttl', 50),
+            'analysis_workers': data.get('analysis_workers', 16),
+            'caption_timeout': data.get('caption_timeout', 20),
+            'similarity_timeout': data.get('similarity_timeout', 20),
+            'profile_sample_rate': data.get('profile_sample_rate', 0),
+            'profile_path': data.get('profile_path', './profiles'),
+            'imagesets': data.get('imagesets') or {'example': './example_imageset/'},
+            'default_imageset': data.get('default_imageset', ''),
+            'shard_size': data.get('shard_size', 100000),
+            'search_workers': data.get('search_workers', 4),
+            'vision_key': data['vision_key'],
+            'vision_endpoint': data['vision_endpoint'],
+            'vectorize_workers': data.get('vectorize_workers', 4),
+            'vectorize_rate_limit': data.get('vectorize_rate_limit', 10),
+            'ann_enabled': data.get('ann_enabled', False),
+            'ann_min_images': data.get('ann_min_images', 20000),
+            'ann_lists': data.get('ann_lists', 0),
+            'ann_probe': data.get('ann_probe', 8),
+            'text_cache_size': data.get('text_cache_size', 4096),
+            'text_cache_path': data.get('text_cache_path', ''),
+            'text_cache_ttl': data.get('text_cache_ttl', 604800),
+            'image_cache_size': data.get('image_cache_size', 1024),
+            'image_cache_ttl': data.get('image_cache_ttl', 86400),
+            'image_max_edge': data.get('image_max_edge', 1024),
+            'image_jpeg_quality': data.get('image_jpeg_quality', 85),
+            'aoai_key': data['aoai_key'],
+            'aoai_endpoint': data['aoai_endpoint'],
+            'image_generation_concurrency': data.get('image_generation_concurrency', 4),
+            'image_generation_timeout': data.get('image_generation_timeout', 120),
+            'generated_image_path': data.get('generated_image_path', './generated'),
+            'generated_image_max_mb': data.get('generated_image_max_mb', 1024),
+            'generated_prompt_cache_size': data.get('generated_prompt_cache_size', 0),
+            'http_connect_timeout': data.get('http_connect_timeout', 5),
+            'http_read_timeout': data.get('http_read_timeout', 60),
+            'http_keepalive_expiry': data.get('http_keepalive_expiry', 120),
+            'http2': data.get('http2', True),
+            'upstream_max_concurrency': data.get('upstream_max_concurrency', 32),
+            'upstream_max_retries': data.get('upstream_max_retries', 3),
+            'circuit_failure_threshold': data.get('circuit_failure_threshold', 5),
+            'circuit_reset_timeout': data.get('circuit_reset_timeout', 30),
+            'save_downloads': data.get('save_downloads', False),
+            'downloads_max_mb': data.get('downloads_max_mb', 512),
+            'line_channel_access_token': data['line_channel_access_token'],
+            'line_channel_secret': data['line_channel_secret'],
+            'line_api_endpoint': data.get('line_api_endpoint', 'https://api.line.me'),
+            'line_data_endpoint': data.get('line_data_endpoint', 'https://api-data.line.me')
+        }
+    return MappingProxyType(config)
+
+
+class LiveConfig(Mapping):
+    """Read-only view of the current config, so module level references see reloads."""
+
+    def __getitem__(self, key):
+        return read_config()[key]
+
+    def __iter__(self):
+        return iter(read_config())
+
+    def __len__(self):
+        return len(read_config())
+
+
+config = LiveConfig()
+
+
+def get_line_content(message_id):
+    """Get file binary from LINE as one in-memory buffer.
 
     :param message_id: message id from line
-    :param message_type: message type from line
-    :return str: file path
+    :return bytes: file content
     """
     config = read_config()
-    url = f'https://api-data.line.me/v2/bot/message/{message_id}/content'
+    url = f"{config['line_data_endpoint']}/v2/bot/message/{message_id}/content"
     headers = {'Authorization': f'Bearer {config["line_channel_access_token"]}'}
-    source = requests.get(url, headers=headers)
+    with metrics.timed('line_download'):
+        source = http_clients.get_client('line').get(url, headers=headers)
+        source.raise_for_status()
+    return source.content
+
+
+def download_content_from_line(message_id, message_type):
+    """Get file binary from LINE without touching disk.
 
+    The content is also saved under ./downloads when save_downloads is enabled.
+
+    :param message_id: message id from line
+    :param message_type: message type from line
+    :return bytes: file content
+    """
+    content = get_line_content(message_id)
+    if read_config()['save_downloads']:
+        save_download(content, message_type)
+    return content
+
+
+def save_download(content, message_type):
+    """Save downloaded content under ./downloads.
+
+    :param bytes content: file content
+    :param message_type: message type from line
+    :return str: file path
+    """
     file_type = {
         'image': 'jpg',
         'video': 'mp4',
@@ -103,11 +375,59 @@ def download_file_from_line(message_id, message_type):
     file_path = \
         f"{path}/{datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')}.{file_type[message_type]}"
     with open(file_path, 'wb') as fd:
-        for chunk in source.iter_content():
-            fd.write(chunk)
+        fd.write(content)
+    prune_directory(path, read_config()['downloads_max_mb'] * 1024 * 1024)
     return file_path
 
 
+def prune_directory(path, max_bytes):
+    """Delete the least recently modified files of a directory until it fits in max_bytes.
+
+    :param str path: Directory path
+    :param int max_bytes: Maximum total size of the files kept
+    :return int: Number of files deleted
+    """
+    files = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in files)
+    deleted = 0
+    for _, size, file_path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        deleted += 1
+    return deleted
+
+
+def download_file_from_line(message_id, message_type):
+    """Get file binary and save them in PC.
+
+    Use to download files from LINE.
+
+    :param message_id: message id from line
+    :param message_type: message type from line
+    :return str: file path
+    """
+    return save_download(get_line_content(message_id), message_type)
+
+
+def normalize_text(text):
+    """Normalize text for cache lookups, ignoring case and extra whitespace.
+
+    :param str text: Text
+    :rtype: str
+    """
+    return ' '.join(text.split()).lower()
+
+
 def get_cosine_similarity(vector1, vector2):
     """Get the cosine similarity between two vectors.
 
@@ -115,29 +435,27 @@ def get_cosine_similarity(vector1, vector2):
     :param list vector2: Vector 2
     :return float cosine_similarity: Cosine similarity
     """
-    dot_product = 0
     length = min(len(vector1), len(vector2))
-
-    for i in range(length):
-        dot_product += vector1[i] * vector2[i]
-
-    magnitude1 = math.sqrt(sum(x * x for x in vector1))
-    magnitude2 = math.sqrt(sum(x * x for x in vector2))
-
-    return dot_product / (magnitude1 * magnitude2)
+    vector1 = np.asarray(vector1, dtype=np.float32)
+    vector2 = np.asarray(vector2, dtype=np.float32)
+    dot_product = np.dot(vector1[:length], vector2[:length])
+    magnitude1 = np.linalg.norm(vector1)
+    magnitude2 = np.linalg.norm(vector2)
+    return float(dot_product / (magnitude1 * magnitude2))
 
 
 def get_top_n_similar_images(target_vector, imageset_vector, n=3):
     """Get top n similar images from imageset.
 
+    Passing an index (ImageIndex or IVFIndex) avoids rebuilding the imageset
+    matrix on every call, a plain {image name: vector} dict is still accepted.
+
     :param list target_vector: Given vector, can be image vector or text vector
-    :param list imageset_vector: Imageset vector
+    :param imageset_vector: Imageset vector, index or dict
     :param int n: Number of similar images, default is 3
     :return list top_n_similar_images: Top n similar images
     """
-    similarity_dict = {}
-    for image in imageset_vector:
-        similarity = get_cosine_similarity(target_vector, imageset_vector[image])
-        similarity_dict[image] = similarity
-    top_n_similar_images = sorted(similarity_dict.items(), key=lambda x: x[1], reverse=True)[:n]
-    return top_n_similar_images
+    if isinstance(imageset_vector, dict):
+        imageset_vector = ImageIndex.from_dict(imageset_vector)
+    with metrics.timed('score'):
+        return imageset_vector.query(target_vector, n=n)